@@ -6,6 +6,7 @@
 CHUNK_SIZE = 5*1024*1024
 #CHUNK_SIZE = 1*1024*1024
 PACKET_SIZE = 1024*1024
+UPLOAD_WORKERS = 4  # number of submissions uploaded in parallel
 
 
 # https://github.com/psf/requests/issues/2181
@@ -21,10 +22,17 @@ HTTPConnection.__init__.__defaults__ = tuple(
 
 from base64 import b64encode
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import os
 import sys
-from csv import DictReader, DictWriter
+import functools
+import mmap
+import atexit
+from csv import DictReader, DictWriter, reader
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 import webvtt
 from lxml import etree
 
@@ -36,6 +44,10 @@ print = tqdm.write
 # While DRY_RUN = True, no actual uploads are made
 DRY_RUN = False
 
+# If True, all files of a submission are committed in a single request (with a combined description, e.g., "Video Figure + Supplemental Materials").
+# Otherwise, each file is committed separately and shows up in the ACM DL with its own description.
+BATCH_COMMITS = False
+
 
 INFO = """This script uploads videos and supplementary materials from the local filesystem
 to the official ACM DL upload form.
@@ -54,13 +66,22 @@ FIELDS_FILE_SUFFIX = "_fields.csv"
 
 CACHE = None # only set once we have the PROCEEDING_ID
 
+# all requests share one session so that connections are kept alive between upload chunks
+SESSION = requests.Session()
+SESSION.headers.update({'Tus-Resumable': '1.0.0'})  # required for all upload requests!
+# one pooled connection per worker; idempotent requests (GET, HEAD, ...) are retried on transient server errors.
+# PATCH and POST are never retried automatically, as the TUS offset would get out of sync.
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=UPLOAD_WORKERS,
+                                      max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=(502, 503, 504))))
+atexit.register(SESSION.close)
+
 def get_doi_list(csvfile):
-    doi = {}
-    with open(csvfile) as fd:
-        dr = DictReader(fd)
-        for paper in dr:
-            doi[paper['PCS_ID']] = paper['DOI']            
-    return doi
+    # only two columns are needed, so we don't build a dict for every row
+    with open(csvfile, newline='') as fd:
+        rows = reader(fd)
+        header = next(rows)
+        pcs_id_col, doi_col = header.index('PCS_ID'), header.index('DOI')
+        return {row[pcs_id_col]: row[doi_col] for row in rows}
 
 DOI_FALLBACK = get_doi_list(TAPS_CSV)
 
@@ -86,32 +107,41 @@ PROCEEDING_ID = None
 ##################################
 
 
+@functools.lru_cache(maxsize=4096)  # author names, emails etc. are encoded again for each file
 def b64(stringy):
     return b64encode(bytes(stringy, 'utf-8')).decode('utf-8')
 
 # ensure that we only upload VTT files
-def srt_to_vtt(filename):
-    try:
-        w = webvtt.read(filename) 
-        print("    caption file already in VTT format")
+@functools.lru_cache(maxsize=None)  # each file only needs to be checked/converted once per run
+def srt_to_vtt(paper_id, filename):
+    # VTT files start with a WEBVTT header - no need to parse the whole file to find out
+    with open(filename, 'rb') as fd:
+        head = fd.read(16)
+    if head.removeprefix(b'\xef\xbb\xbf').lstrip().startswith(b'WEBVTT'):
+        print(f"    {paper_id}: caption file already in VTT format")
         return
-    except (webvtt.errors.MalformedFileError, webvtt.errors.MalformedCaptionError):
-        try: 
-            w = webvtt.from_srt(filename)
-            w.save(filename)
-            print("    caption file converted to VTT")
-        except (webvtt.errors.MalformedFileError, webvtt.errors.MalformedCaptionError, UnicodeDecodeError):
-            print("    no caption file, skipping conversion!")
+    try: 
+        w = webvtt.from_srt(filename)
+        w.save(filename)
+        print(f"    {paper_id}: caption file converted to VTT")
+    except (webvtt.errors.MalformedFileError, webvtt.errors.MalformedCaptionError, UnicodeDecodeError):
+        print(f"    {paper_id}: no caption file, skipping conversion!")
+
 
+# conversions applied to files before uploading them (by file extension)
+PRE_UPLOAD = {'.vtt': srt_to_vtt}
+
+
+TOKEN_RE = re.compile(rb'data-token="([a-zA-Z0-9=]+)"')  # matched against the raw bytes - no need to decode the page
 
 def get_token():
     if DRY_RUN:
         return "TOKENTEST"
     TOKEN_URL = f"https://acmsubmit.acm.org/videosubmission.cfm?proceedingID={PROCEEDING_ID}"
-    r = requests.get(TOKEN_URL)
-    tokens = re.search(r'data-token="([a-zA-Z0-9=]+)"', r.text).groups()
-    if tokens:
-        token = tokens[0]
+    r = SESSION.get(TOKEN_URL)
+    match = TOKEN_RE.search(r.content)
+    if match:
+        token = match.group(1).decode('ascii')
     else:
         raise RuntimeError("Token not available - is the portal currently ready for uploads?")
     assert token
@@ -122,54 +152,95 @@ def get_token():
 # 5 MB seems to be the maximum chunk size the ACM portal accepts
 
 
-def chunked(fd, chunk_size=CHUNK_SIZE):
-    while data := fd.read(chunk_size):
-        yield data
-
-
-def upload_file(token, path, filename, upload_filename, filetype, author, email, doi, description):
-    if DRY_RUN: 
-        print(f"    DRY RUN: uploaded file {filename} as {upload_filename} ({description})")
+# Chunks are slices of a memory map of the file, so no new bytes object is allocated per chunk.
+def chunked(fd, filesize, chunk_size=CHUNK_SIZE):
+    if filesize == 0:  # empty files cannot be mapped
+        return
+    with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # let the kernel read the next chunk from disk while the current one is being sent (not available on all OSes)
+        prefetch = hasattr(mmap, "MADV_WILLNEED")
+        if prefetch:
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mm)
+        for offset in range(0, len(mm), chunk_size):
+            next_offset = offset + chunk_size
+            if prefetch and next_offset < len(mm):
+                mm.madvise(mmap.MADV_WILLNEED, next_offset, min(chunk_size, len(mm) - next_offset))
+            chunk = view[offset:offset + chunk_size]
+            yield chunk
+            chunk.release()  # the map can only be closed once all views are released
+        view.release()
+
+
+# Creates the TUS upload and returns its URL (the PATCH target).
+# uploader_metadata: the TUS metadata part that is the same for all files of a submission (see upload_submission)
+def create_upload(paper_id, token, filesize, upload_filename, filetype, uploader_metadata, description):
+    if DRY_RUN:
         return ""
-    filesize = int(os.path.getsize(path))
-    metadata = f"filename {b64(upload_filename)},filetype {b64(filetype)},yourName {b64(author)},yourEmailAddress {b64(email)},doi {b64(doi)},description {b64(description)}"
+    metadata = ",".join((f"filename {b64(upload_filename)}", f"filetype {b64(filetype)}", uploader_metadata, f"description {b64(description)}"))
     HEADERS = {'Authorization': f"Atypon {token}",
            'Upload-Metadata': metadata, 
-           'Upload-Length' : str(filesize),
-           'Tus-Resumable': '1.0.0'        # required!
+           'Upload-Length' : str(filesize)
           }
-    r = requests.post(UPLOAD_URL, headers=HEADERS)
+    r = SESSION.post(UPLOAD_URL, headers=HEADERS)
     assert(r.status_code == 201)
-    print("got upload path")
-    UPLOAD_PATH = r.headers['Location']
+    print(f"    {paper_id}: got upload path")
+    return r.headers['Location']
+
+
+class ChunkReader:
+    """File-like PATCH body for one chunk. http.client reads it in blocks of PACKET_SIZE,
+    so the progress bar is updated while the chunk is being sent. As it has a length,
+    requests still sends a Content-Length (TUS does not allow chunked transfer encoding)."""
+    def __init__(self, chunk, progress_bar):
+        self.chunk = chunk
+        self.offset = 0
+        self.progress_bar = progress_bar
+
+    def __len__(self):
+        return len(self.chunk)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.chunk) - self.offset
+        block = self.chunk[self.offset:self.offset + size]
+        self.offset += len(block)
+        self.progress_bar.update(len(block))
+        return block
+
 
+def upload_file(paper_id, token, path, filesize, filename, upload_filename, description, UPLOAD_PATH):
+    if DRY_RUN: 
+        print(f"    {paper_id}: DRY RUN: uploaded file {filename} as {upload_filename} ({description})")
+        return ""
     progress_bar = tqdm(total=filesize, unit='iB', unit_scale=True, leave=False)
     offset = 0
-    for chunk in chunked(open(path, 'rb')):
-        length = len(chunk)
-        #print(f"    Uploaded {offset//(1000*1000)} / {filesize//(1000*1000)} MB", end='\r') 
-        HEADERS = {'Authorization': f"Atypon {token}",
-               'Tus-Resumable': '1.0.0',
-               'Upload-Offset': str(offset),
-               'Content-Type': 'application/offset+octet-stream',
-               'Content-Length': str(length)
-              }
-        r = requests.patch(UPLOAD_PATH, data=chunk, headers=HEADERS)
-        progress_bar.update(length)
-        offset +=length
-        #print(f"Headers: {r.headers}")
-        #print(r.status_code)
-        #print(r.text)
-        assert(r.status_code==204)
-    print(f"    Uploaded to: {UPLOAD_PATH}")
+    PATCH_HEADERS = {'Authorization': f"Atypon {token}",
+                     'Content-Type': 'application/offset+octet-stream'
+                    }
+    with open(path, 'rb') as fd:
+        for chunk in chunked(fd, filesize):
+            length = len(chunk)
+            #print(f"    Uploaded {offset//(1000*1000)} / {filesize//(1000*1000)} MB", end='\r') 
+            HEADERS = {**PATCH_HEADERS,
+                   'Upload-Offset': str(offset),
+                   'Content-Length': str(length)
+                  }
+            r = SESSION.patch(UPLOAD_PATH, data=ChunkReader(chunk, progress_bar), headers=HEADERS)
+            offset +=length
+            #print(f"Headers: {r.headers}")
+            #print(r.status_code)
+            #print(r.text)
+            assert(r.status_code==204)
+    print(f"    {paper_id}: Uploaded to: {UPLOAD_PATH}")
     progress_bar.close()
     return UPLOAD_PATH
 
 
 
-def commit_submission(author, email, doi, description, filenames_urls):
+def commit_submission(paper_id, author, email, doi, description, filenames_urls):
     if DRY_RUN:
-        print(f"    DRY RUN: committing: {description}")
+        print(f"    {paper_id}: DRY RUN: committing: {description}")
         return True
     post_metadata = {'yourName': author,
                  'yourEmailAddress': email,
@@ -182,13 +253,15 @@ def commit_submission(author, email, doi, description, filenames_urls):
         filename, url = fu
         post_metadata[f"file-name-{idx+1}"] = filename
         post_metadata[f"file-url-{idx+1}"] = url
-    r = requests.post(SUBMIT_URL, data = post_metadata)  
+    r = SESSION.post(SUBMIT_URL, data = post_metadata)  
     assert(r.status_code == 200)
     return True
 
 
 
-def upload_submission(track_id, sub, filetypes, already_uploaded_files):
+uploaded_files_lock = threading.Lock()
+
+def upload_submission(track_id, sub, filetypes, already_uploaded_files, existing_files):
     submission_ready_field = filetypes[0]['ready_field']
     if len(submission_ready_field) > 0:
         if sub[submission_ready_field] == "":
@@ -203,78 +276,117 @@ def upload_submission(track_id, sub, filetypes, already_uploaded_files):
     doi = doi.removeprefix("https://doi.org/")
     doi_part = doi.split("/")[-1]
     assert(len(doi_part) > 0)
+    if UPLOADER_NAME and UPLOADER_EMAIL:
+        uploader_name, uploader_email = UPLOADER_NAME, UPLOADER_EMAIL
+    else:
+        uploader_name, uploader_email = sub['Contact Name'], sub['Contact Email'],
+    uploader_metadata = f"yourName {b64(uploader_name)},yourEmailAddress {b64(uploader_email)},doi {b64(doi)}"
+    paper_id = sub['Paper ID']  # log lines of parallel uploads get interleaved
     token = None  # TODO: do we need a new token for every submission?
+    uploads = []  # files that need to be uploaded
     for filetype in filetypes:
         if filetype['upload_to_dl'] == "no":
-            print(f"Skipping '{filetype['description']}': not to be uploaded to DL")
+            print(f"    {paper_id}: Skipping '{filetype['description']}': not to be uploaded to DL")
             continue
         if filetype['upload_to_dl'] != "yes":  # explicit agreement needed!
             agreement_field = filetype['upload_to_dl']
             if sub[agreement_field] == "": # agreement missing
-                print(f"Skipping '{filetype['description']}': no agreement from authors")
+                print(f"    {paper_id}: Skipping '{filetype['description']}': no agreement from authors")
                 continue
         # else
         filename = f"{sub['Paper ID']}{filetype['suffix']}"
         upload_filename = f"{doi_part}{filetype['suffix']}"
         filepath = f"{track_id}_{filetype['directory']}/{filename}"
-        if not os.path.isfile(filepath):
-            print(f"    No file for: {filepath} (probably not submitted)")
+        if filename not in existing_files[filetype['directory']]:
+            print(f"    {paper_id}: No file for: {filepath} (probably not submitted)")
             continue
-        if filepath.endswith(".vtt"):
-            srt_to_vtt(filepath)
+        if filetype['_pre_upload']:
+            filetype['_pre_upload'](paper_id, filepath)
         if not token:
             token = get_token()
         #description = f"{filetype['description']} for Publication {sub['Paper ID']} (doi:{doi})"
         # Better - because this is what shows up on the DL page, so any DOI is irrelevant
         description = f"{filetype['description']}"
-        if upload_filename in already_uploaded_files:
-            print(f"    Already uploaded '{upload_filename}'... skipping it")
-            continue
+        with uploaded_files_lock:  # several submissions are uploaded at once
+            if upload_filename in already_uploaded_files:
+                print(f"    {paper_id}: Already uploaded '{upload_filename}'... skipping it")
+                continue
+            already_uploaded_files.add(upload_filename)  # so that no other worker uploads it again
         # else
-        if UPLOADER_NAME and UPLOADER_EMAIL:
-            uploader_name, uploader_email = UPLOADER_NAME, UPLOADER_EMAIL
-        else:
-            uploader_name, uploader_email = sub['Contact Name'], sub['Contact Email'],
-        print(f"    Uploading {filetype['description']} file: {filepath} as {upload_filename}")
-        url = upload_file(token, filepath, filename, upload_filename, filetype['mimetype'], uploader_name, uploader_email,  doi, description)
-        filenames_urls = [] # leftover from earlier version where all files for one submission were committed together. Left here in case the former behavior should be restored
-        filenames_urls.append((upload_filename, url))
-        commit_description = description  # the commit_description is what actually shows up on the ACM DL!
-        print("    Committing")
-        commit_submission(uploader_name, uploader_email, doi, commit_description, filenames_urls)           
-        print("    Done")
+        filesize = os.stat(filepath).st_size  # only now - srt_to_vtt() might have rewritten the file
+        uploads.append((filetype, filename, upload_filename, filepath, filesize, description))
+    filenames_urls = []
+    # The uploads are created (POST) in the background while the previous file's chunks are still being sent
+    with ThreadPoolExecutor(max_workers=1) as creator:
+        upload_paths = [creator.submit(create_upload, paper_id, token, filesize, upload_filename, filetype['mimetype'], uploader_metadata, description)
+                        for filetype, filename, upload_filename, filepath, filesize, description in uploads]
+        for (filetype, filename, upload_filename, filepath, filesize, description), upload_path in zip(uploads, upload_paths):
+            print(f"    {paper_id}: Uploading {filetype['description']} file: {filepath} as {upload_filename}")
+            url = upload_file(paper_id, token, filepath, filesize, filename, upload_filename, description, upload_path.result())
+            if BATCH_COMMITS:
+                filenames_urls.append((upload_filename, url))
+                continue
+            filenames_urls = [(upload_filename, url)]
+            commit_description = description  # the commit_description is what actually shows up on the ACM DL!
+            print(f"    {paper_id}: Committing")
+            commit_submission(paper_id, uploader_name, uploader_email, doi, commit_description, filenames_urls)           
+            print(f"    {paper_id}: Done")
+    if BATCH_COMMITS and filenames_urls:
+        commit_description = " + ".join(upload[-1] for upload in uploads)
+        print(f"    {paper_id}: Committing")
+        commit_submission(paper_id, uploader_name, uploader_email, doi, commit_description, filenames_urls)
+        print(f"    {paper_id}: Done")
+
+def iter_uploaded_rows(stream):
+    """Yields the rows (<tr>) of the publications table while the listing is parsed incrementally.
+    Each row is freed once the caller has processed it."""
+    for _, row in etree.iterparse(stream, events=("end",), tag="tr", html=True):
+        table = row.getparent()
+        if table is None or table.get('id') != 'publications':
+            continue
+        yield row
+        row.clear()
+        while row.getprevious() is not None:
+            del table[0]
+
+# columns of the cache file
+UPLOADED_FIELDS = ['excluded', 'Edit URL', 'skinnyID', 'Paper ID', 'Load Date', 'Contact', 'Email', 'DOI',
+                   'File Description', 'File Name', 'File URL']
 
 # include_excluded = False so that we can upload new revisions of files by excluding the old version
 def get_uploaded_submissions(conf_id, include_excluded=False):
     print("Getting already uploaded submissions")
     URL=f"https://acmsubmit.acm.org/atyponListing.cfm?proceedingID={conf_id}"
-    content = requests.get(URL).text
-    root = etree.HTML(content)
-    rows = root.xpath("//table[@id = 'publications']/tr")
+    r = SESSION.get(URL, stream=True)
+    r.raw.decode_content = True  # undo gzip/deflate transfer encoding
+    rows = iter_uploaded_rows(r.raw)
     #print(f"Found {len(rows)} submissions (including excluded ones).")
 
     submissions = []
-    for row in rows:
-        submission= {}
-        excluded = row[0][0].tail.endswith("excluded")
-        submission['excluded'] = excluded
-        submission['Edit URL'] = row[0][0].attrib['href']
-        skinny_id_string = submission['Edit URL'].split('&')[-1]
-        assert(skinny_id_string.split('=')[0] == 'skinnyID')
-        submission['skinnyID'] = skinny_id_string.split('=')[1]
-        submission['Paper ID'] = row[1].text
-        submission['Load Date'] = row[2].text
-        submission['Contact'] = row[3][0].text
-        submission['Email'] = row[3][0].attrib['href'].removeprefix("mailto:")
-        submission['DOI'] = row[4].text
-        submission['File Description'] = row[5].text
-        submission['File Name'] = row[6][0].text
-        submission['File URL'] = row[6][0].attrib['href']
-        submissions.append(submission)
-    with open(CACHE,'w') as fd:
-        dw = DictWriter(fd, submissions[0].keys())
+    with open(CACHE, 'w') as fd:  # rows are written as they are parsed
+        dw = DictWriter(fd, UPLOADED_FIELDS)
         dw.writeheader()
-        dw.writerows(submissions)
+        for row in rows:
+            submission= {}
+            # each cell and link is looked up only once
+            edit_cell, paper_id_cell, date_cell, contact_cell, doi_cell, description_cell, file_cell = row[:7]
+            edit_link, contact_link, file_link = edit_cell[0], contact_cell[0], file_cell[0]
+            excluded = edit_link.tail.endswith("excluded")
+            submission['excluded'] = excluded
+            submission['Edit URL'] = edit_link.get('href')
+            skinny_id_string = submission['Edit URL'].split('&')[-1]
+            assert(skinny_id_string.split('=')[0] == 'skinnyID')
+            submission['skinnyID'] = skinny_id_string.split('=')[1]
+            submission['Paper ID'] = paper_id_cell.text
+            submission['Load Date'] = date_cell.text
+            submission['Contact'] = contact_link.text
+            submission['Email'] = contact_link.get('href').removeprefix("mailto:")
+            submission['DOI'] = doi_cell.text
+            submission['File Description'] = description_cell.text
+            submission['File Name'] = file_link.text
+            submission['File URL'] = file_link.get('href')
+            dw.writerow(submission)
+            submissions.append(submission)
     already_uploaded = submissions
     already_uploaded_without_excluded = [d for d in submissions if not d['excluded']]
     excluded = [d for d in submissions if d['excluded']]
@@ -286,13 +398,32 @@ def get_uploaded_submissions(conf_id, include_excluded=False):
 
 
 
+def list_files(directory):
+    try:
+        return set(os.listdir(directory))
+    except FileNotFoundError:
+        return set()
+
+
 def upload(track_id, filetypes):
-    ALREADY_UPLOADED_FILES = [sub['File Name'] for sub in get_uploaded_submissions(PROCEEDING_ID)]
+    ALREADY_UPLOADED_FILES = {sub['File Name'] for sub in get_uploaded_submissions(PROCEEDING_ID)}  # set for fast lookups
+    # list each directory once instead of checking every single file
+    existing_files = {ft['directory']: list_files(f"{track_id}_{ft['directory']}") for ft in filetypes}
+    for ft in filetypes:  # look up the conversion for each file type once
+        ft['_pre_upload'] = PRE_UPLOAD.get(os.path.splitext(ft['suffix'])[1])
     fd = open(f"{track_id}{LIST_FILE_SUFFIX}", encoding='utf-8-sig')  # CSV has BOM
     submissions = DictReader(fd)
-    for idx, submission in enumerate(tqdm(submissions, desc="Submissions processed", leave=False)):
+
+    def upload_one(idx, submission):
         print(f"[{idx}] Paper: {submission['Paper ID']} ({submission['Title']})")
-        upload_submission(track_id, submission, filetypes, ALREADY_UPLOADED_FILES)
+        upload_submission(track_id, submission, filetypes, ALREADY_UPLOADED_FILES, existing_files)
+
+    # uploads mostly wait for the network, so several submissions are uploaded at once
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = [executor.submit(upload_one, idx, submission) for idx, submission in enumerate(submissions)]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Submissions processed", leave=False):
+            future.result()
+    fd.close()
 
 
 def print_help():
@@ -327,7 +458,7 @@ def exclude(query, submissions, column="File Name"):
                 'exclude'     : 'on',
                 'submit'      : 'Submit'
                 }
-        r = requests.post(url, data=data)
+        r = SESSION.post(url, data=data)
         assert(r.status_code == 300)
 
 
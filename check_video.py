@@ -2,14 +2,15 @@
 
 import json
 import sys
-import sh
-from sh import ffprobe
+import subprocess
 from os.path import basename
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor
 
 def get(filename):
-    j = ffprobe("-v", "quiet", "-print_format", "json", "-show_format", "-show_streams", filename)
-    t = json.loads(str(j))
+    j = subprocess.run(["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", "-show_streams", filename],
+                       capture_output=True, check=True).stdout
+    t = json.loads(j)
     return t
 
 def streams(metadata):
@@ -29,11 +30,11 @@ def streams(metadata):
 
 
 def check(filename, details=False):
+    name = basename(filename)
     try:
         metadata = get(filename)
     except:
         return(name, "Error - could not check file - maybe not a video?", "", "", "", "", "", "", "", "")
-    name = basename(filename)
     try:
         audio, video = streams(metadata)
     except ValueError:
@@ -60,10 +61,13 @@ def check(filename, details=False):
     return (name, duration, cformat, vcodec_name, width, height, r_frame_rate, acodec_name, sample_rate, channels)
 
 
-FILES = sys.argv[1:]
-#glob(PATH+"/*")
+if __name__ == "__main__":
+    FILES = sys.argv[1:]
+    #glob(PATH+"/*")
 
-print("name,duration,container format,video codec,width,height,frame rate,audio codec,sample rate,channels")
-for f in FILES:
-    print(",".join(map(str,check(f))))
+    print("name,duration,container format,video codec,width,height,frame rate,audio codec,sample rate,channels")
+    # every file gets its own ffprobe process; map() keeps the output in the order of FILES
+    with ProcessPoolExecutor() as executor:
+        for row in executor.map(check, FILES, chunksize=8):
+            print(",".join(map(str,row)))
 
@@ -20,8 +20,16 @@ import os
 import re
 import sys
 import glob
+import io
 import shutil
-from csv import DictReader, DictWriter
+import pickle
+import hashlib
+import functools
+from importlib.metadata import version, PackageNotFoundError
+from contextlib import redirect_stdout
+from multiprocessing import Pool
+from csv import DictWriter, reader
+from collections import Counter
 from lxml import etree, html
 
 # additional
@@ -31,6 +39,14 @@ from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfparser import PDFParser
 from pdfminer.high_level import extract_text
 from pdfminer.pdftypes import resolve1
+try:  # optional, much faster text extraction
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+try:  # optional, much faster text extraction (AGPL license)
+    import pymupdf
+except ImportError:
+    pymupdf = None
 
 # replace print function with tqdm
 #print = tqdm.write
@@ -39,86 +55,158 @@ def print(thing, end="\n"):
     tqdm.write(str(thing), end=end)
 
 OUTPUT_DIR = "LINTER_RESULTS"
-SORT_FILES = True  # sort files with failed checks in subfolders per check (warning: may lead to many duplicates of each file)
+HTML_DIR = "./TAPS_HTML"
+# html_files = glob.glob(f'{HTML_DIR}/*.html') # currently we only iterate over the PDF files
+TAPS_PDF_DIR = "./TAPS_PDF"
+# "pypdfium2" and "pymupdf" extract text much faster (metadata is always read with pdfminer)
+# can be overridden with the environment variable PUBTOOLS_PDF_BACKEND
+PDF_TEXT_BACKEND = os.environ.get("PUBTOOLS_PDF_BACKEND", "pdfminer")
+CACHE_DIR = f"{OUTPUT_DIR}/.cache"  # extracted PDF/HTML info, so that re-runs only process changed files
+USE_CACHE = True
+SORT_FILES = True  # sort files with failed checks in subfolders per check (as hard links, so the PDFs are not duplicated)
 # SORT_FILES = False  # do not sort files in subfolders per check
 
 
 def stringify_list(a_list):
     if len(a_list) == 0:
         return ""
-    text = ""
+    parts = []
     for line in a_list[:-1]:
         line = line.strip()
         if line.endswith("-"):
-            text += line[:-1]
+            parts.append(line[:-1])
         elif "https" in line:  # make sure that our DOI stays intact
-            text += line
+            parts.append(line)
         else:
-            text += line + " "
-    text += a_list[-1].strip()
-    return text
+            parts.append(line + " ")
+    parts.append(a_list[-1].strip())
+    return "".join(parts)
+
+
+CCS_CONCEPTS_RE = re.compile('CCS Concepts: (.*?;)+')
+REFERENCE_RE = re.compile(r'(^\[[0-9]+\] .*)', re.MULTILINE)  # "[12] Author et al. ..."
+DOI_RE = re.compile(r'(https://doi.org/10.1145/[0-9\.]+)')
+PCS_ID_RE = re.compile(r'[a-z]+[0-9]+')  # e.g. pn1234
+COPYRIGHT_STARTS = ("Permission to make", "This work is licensed")
+# lines that start one of the blocks in the header of an ACM paper (or the first section: "1 INTRODUCTION")
+LINE_START_RE = re.compile("|".join(re.escape(start) for start in (
+    "1 ", *COPYRIGHT_STARTS, "ABSTRACT", "CCS CONCEPTS", "KEYWORDS", "ACM Reference Format")))
+
+# elements of the TAPS HTML files (compiled once instead of on every call)
+BODY_XPATH = etree.XPath("//section[@class = 'body']")
+TITLE_XPATH = etree.XPath("//title")
+CCS_XPATH = etree.XPath("//ccs2012")
+DOI_XPATH = etree.XPath("//div[@class = 'pubInfo']//a")
+KEYWORDS_XPATH = etree.XPath("//div[@class='classifications']//span[@class = 'keyword']/small")
+AUTHORS_XPATH = etree.XPath("//div[@class = 'authorGroup']/div[@class = 'author']")
+FIGURES_XPATH = etree.XPath("//figure")
+TABLES_XPATH = etree.XPath("//table[@class = 'table']")
+REFERENCES_XPATH = etree.XPath("//ul[@class = 'bibUl']/li")
+
+
+# pdf_file can be a path or a binary file object
+def extract_pdf_text(pdf_file):
+    if PDF_TEXT_BACKEND == "pypdfium2":
+        if pdfium is None:
+            raise RuntimeError("PDF_TEXT_BACKEND is 'pypdfium2' but pypdfium2 is not installed")
+        pdf = pdfium.PdfDocument(pdf_file)
+        try:
+            # same layout as pdfminer's output: \n between lines, form feed between pages
+            return "\f".join(page.get_textpage().get_text_range().replace("\r\n", "\n") for page in pdf)
+        finally:
+            pdf.close()
+    if PDF_TEXT_BACKEND == "pymupdf":
+        if pymupdf is None:
+            raise RuntimeError("PDF_TEXT_BACKEND is 'pymupdf' but pymupdf is not installed")
+        if hasattr(pdf_file, "read"):
+            pdf_file.seek(0)
+            pdf = pymupdf.open(stream=pdf_file.read(), filetype="pdf")
+        else:
+            pdf = pymupdf.open(pdf_file)
+        with pdf:
+            return "\f".join(page.get_text() for page in pdf)
+    return extract_text(pdf_file)
 
 
-def get_info_from_html(html_file):
-    info = {}
+def parse_html(html_file):
     try:
-        root = html.parse(html_file)
+        return html.parse(html_file)
     except OSError:
         print(f"    file not found: {html_file}")
-        return info
-    body = root.xpath("//section[@class = 'body']")[0]
-    # print(body.text_content())
-    info['CHARACTER COUNT'] = len(body.text_content())
-    info['WORD COUNT'] = len(body.text_content().split())
+        return None
+
+
+# root can be passed in if the caller already parsed the file
+# returns the info dict and the text of the paper body (which is needed for the checks anyway)
+def get_info_from_html(html_file, root=None):
+    info = {}
+    if root is None:
+        root = parse_html(html_file)
+        if root is None:
+            return info, ""
+    body = BODY_XPATH(root)[0]
+    body_text = body.text_content()  # builds a new string on every call
+    # print(body_text)
+    info['CHARACTER COUNT'] = len(body_text)
+    info['WORD COUNT'] = len(body_text.split())
     
-    title = root.xpath("//title")[0]
+    title = TITLE_XPATH(root)[0]
     info['TITLE'] = title.text_content()
      
     # too hard - seems inconsistent.
-    concepts = root.xpath("//ccs2012")
+    concepts = CCS_XPATH(root)
     if len(concepts) == 1: # TODO: check when len is not 1
-        concept_list = (re.findall('CCS Concepts: (.*?;)+', concepts[0].text_content()))
+        concept_list = (CCS_CONCEPTS_RE.findall(concepts[0].text_content()))
         info['CCS CONCEPTS'] = "".join(concept_list)
     else:
         print(f"# {html_file}: concepts not found")
     
-    doi = root.xpath("//div[@class = 'pubInfo']//a")[0] # 1 would be proceedings DOI
+    doi = DOI_XPATH(root)[0] # 1 would be proceedings DOI
     info['DOI'] = doi.text_content()
     
-    keywords = root.xpath("//div[@class='classifications']//span[@class = 'keyword']/small")
+    keywords = KEYWORDS_XPATH(root)
     info['KEYWORDS'] = "; ".join([k.text_content() for k in keywords])
     
-    authors = root.xpath("//div[@class = 'authorGroup']/div[@class = 'author']")
+    authors = AUTHORS_XPATH(root)
     info['AUTHOR COUNT'] = len(authors)
     info['AUTHORS'] = [author.text_content().replace("\r\n", "").split(",") for author in authors]
     
-    figures = root.xpath("//figure")
+    figures = FIGURES_XPATH(root)
     info['FIGURE COUNT'] = len(figures)
     
-    tables = root.xpath("//table[@class = 'table']")
+    tables = TABLES_XPATH(root)
     info['TABLE COUNT'] = len(tables)
     
-    references = root.xpath("//ul[@class = 'bibUl']/li")
+    references = REFERENCES_XPATH(root)
     info['REFERENCE COUNT'] = len(references)
 
-    return(info)
+    return info, body_text
 
 
 
-def extract_html_text(html_file):
-    try:
-        root = html.parse(html_file)
-    except OSError:
-        print(f"file not found: {html_file}")
-        return ""       
-    body = root.xpath("//section[@class = 'body']")[0]
-    return body.text_content()
+def iter_lines(text):
+    # same lines as text.splitlines(), but split page by page (pages end with a form feed) so that
+    # we don't build a list of all lines of the paper when we only need those of the first page
+    start = 0
+    while start < len(text):
+        end = text.find("\f", start)
+        end = len(text) if end == -1 else end + 1
+        yield from text[start:end].splitlines()
+        start = end
+
 
+def decode_pdf_string(value):
+    # PDF metadata strings are UTF-16 if they start with a byte order mark
+    if value[:1] in (b"\xfe", b"\xff"):
+        return value.decode('utf-16')
+    return value.decode('utf-8', errors='replace')
 
 
-def get_info_from_pdf(pdf_file, debug = False):
+# text and doc can be passed in if the caller already extracted/parsed them - both are expensive
+def get_info_from_pdf(pdf_file, text=None, doc=None, debug = False):
     pdf_info = {}
-    doc = PDFDocument(PDFParser(open(pdf_file, 'rb')))
+    if doc is None:
+        doc = PDFDocument(PDFParser(open(pdf_file, 'rb')))
     pdf_info["EMBEDDED FILES"] = False
     try:
         for xref in doc.xrefs:
@@ -129,24 +217,14 @@ def get_info_from_pdf(pdf_file, debug = False):
     except AttributeError:
         pass
     pdf_properties = doc.info[0]
-    if 'Creator' in pdf_properties:
-        if pdf_properties['Creator'][0] in [0xfe, 0xff]:
-            pdf_info['PDF CREATOR'] = pdf_properties['Creator'].decode('utf-16')
-        else:
-            pdf_info['PDF CREATOR'] = pdf_properties['Creator'].decode('utf-8')
-    else:
-        pdf_info['PDF CREATOR'] = ""
-    if 'Producer' in pdf_properties:
-        if pdf_properties['Producer'][0] in [0xfe, 0xff]:
-            pdf_info['PDF PRODUCER'] = pdf_properties['Producer'].decode('utf-16')
-        else:
-            pdf_info['PDF PRODUCER'] = pdf_properties['Producer'].decode('utf-8')
-    else:
-        pdf_info['PDF PRODUCER'] = ""
+    pdf_info['PDF CREATOR'] = decode_pdf_string(pdf_properties.get('Creator', b""))
+    pdf_info['PDF PRODUCER'] = decode_pdf_string(pdf_properties.get('Producer', b""))
 
-    text = extract_text(pdf_file)
-    references = text[text.find("REFERENCES"):]
-    num_references = len(re.findall(r'(^\[[0-9]+\] .*)', references, re.MULTILINE))
+    if text is None:
+        text = extract_pdf_text(pdf_file)
+    # count from the REFERENCES heading on, without copying the rest of the text
+    references_start = text.find("REFERENCES")
+    num_references = len(REFERENCE_RE.findall(text, references_start)) if references_start != -1 else 0
 
     # states
     TITLE = 0
@@ -158,7 +236,7 @@ def get_info_from_pdf(pdf_file, debug = False):
     COPYRIGHT = 6  # can appear between other blocks
     BODY = 7
     DONE = 99
-
+    SECTION_STATES = {"ABSTRACT": ABSTRACT, "CCS CONCEPTS": CCS_CONCEPTS, "KEYWORDS": KEYWORDS, "ACM Reference Format": ACM_REF}
 
     title = []
     authors = [[]]
@@ -170,24 +248,18 @@ def get_info_from_pdf(pdf_file, debug = False):
 
     state = TITLE
     prev_state = TITLE
-    for line in text.splitlines():
-        if line.startswith("1 ") and len(acm_ref) > 0: 
-            break # we have really reached the first line    
-        if line.startswith("Permission to make") or line.startswith("This work is licensed"):
-            prev_state = state
-            state = COPYRIGHT
-        if line.startswith("ABSTRACT"):
-            state = ABSTRACT
-            continue
-        elif line.startswith("CCS CONCEPTS"):
-            state = CCS_CONCEPTS
-            continue
-        elif line.startswith("KEYWORDS"):
-            state = KEYWORDS
-            continue
-        elif line.startswith("ACM Reference Format"):
-            state = ACM_REF
-            continue
+    for line in iter_lines(text):  # we usually stop on the first page
+        # one regex match for all special line starts, most lines are none of them
+        if special := LINE_START_RE.match(line):
+            special = special.group()
+            if special == "1 " and len(acm_ref) > 0:
+                break # we have really reached the first line    
+            if special in COPYRIGHT_STARTS:
+                prev_state = state
+                state = COPYRIGHT
+            elif special in SECTION_STATES:
+                state = SECTION_STATES[special]
+                continue
         if debug:
             print(state, line) # debug
 
@@ -222,7 +294,7 @@ def get_info_from_pdf(pdf_file, debug = False):
     pdf_info['ACM REF'] = stringify_list(acm_ref)
     pdf_info['KEYWORDS'] = stringify_list(keywords)
     pdf_info['CCS CONCEPTS'] = stringify_list(ccs_concepts)
-    if doi := re.search(r'(https://doi.org/10.1145/[0-9\.]+)', stringify_list(acm_ref)):
+    if doi := DOI_RE.search(pdf_info['ACM REF']):
         pdf_info['DOI'] = doi.groups()[0]
     else:
         pdf_info['DOI'] = ""
@@ -234,19 +306,11 @@ def get_info_from_pdf(pdf_file, debug = False):
     return pdf_info
 
 
-def get_pdf_catalog(pdf_file):
-    fp = open(pdf_file, 'rb')
-    parser = PDFParser(fp)
-    doc = PDFDocument(parser)
-    catalog = doc.catalog
-    return catalog
-
-
 # Attention: some of the checks below don't work very well due to difficulties in extracting text from PDF
 
 def check_pdf_difference_taps_pdf(data):
-    pcs_size = os.stat(data["pdf_file"]).st_size
-    taps_size = os.stat(data["taps_pdf_file"]).st_size
+    pcs_size = data["pcs_size"]
+    taps_size = data["taps_size"]
     if pcs_size == taps_size:
         return "File sizes in TAPS and PCS are identical - probably no accessibility check done."
     if pcs_size / taps_size > 1.2 or pcs_size / taps_size < 0.8:
@@ -254,7 +318,7 @@ def check_pdf_difference_taps_pdf(data):
 
 
 def check_pdf_size(data):
-    pcs_size = os.stat(data["pdf_file"]).st_size
+    pcs_size = data["pcs_size"]
     if pcs_size > 1000*1000*70:
         return f"PDF file larger than 70 MB: {pcs_size/1000000.0:.2f} MB."
     if pcs_size < 1000*100:
@@ -277,22 +341,13 @@ def check_embedded_files(data):
         return f"PDF contains embedded files (typically reports from the Acrobat accessibility checker."
 
 
-# works reliably
-def check_ligatures_fi(data):
-    if data['html_text'].find("fi") != -1 and data['pdf_text'].find("fi") == -1:
-        return "Accessibility: the PDF plain text does not contain the letters 'fi' (but HTML does). Please check whether ligatures are encoded correctly."
-
-
-# works reliably
-def check_ligatures_ff(data):
-    if data['html_text'].find("ff") != -1 and data['pdf_text'].find("ff") == -1:
-        return "Accessibility: the PDF plain text does not contain the letters 'ff' (but HTML does). Please check whether ligatures are encoded correctly."
-
+LIGATURES = ("fi", "ff", "Qu")  # letter combinations that are often typeset as a single glyph
 
 # works reliably
-def check_ligatures_qu(data):
-    if data['html_text'].find("Qu") != -1 and data['pdf_text'].find("Qu") == -1:
-        return "Accessibility: the PDF plain text does not contain the letters 'Qu' (but HTML does). Please check whether ligatures are encoded correctly."
+def check_ligatures(data):
+    missing = [f"'{ligature}'" for ligature in LIGATURES if ligature in data['html_text'] and ligature not in data['pdf_text']]
+    if missing:
+        return f"Accessibility: the PDF plain text does not contain the letters {', '.join(missing)} (but HTML does). Please check whether ligatures are encoded correctly."
 
 
 TAPS_PDF_CREATORS = ['LaTeX with acmart 2022/10/24 v1.88 Typesetting articles for the Association for Computing Machinery and hyperref 2022-02-21 v7.00n Hypertext links for LaTeX', 
@@ -305,34 +360,47 @@ def check_pdf_creator(data):
 
 
 def get_doi_list(csvfile):
-    doi = {}
-    with open(csvfile) as fd:
-        dr = DictReader(fd)
-        for paper in dr:
-            doi[paper['PCS_ID']] = paper['DOI']            
-    return doi
+    # only two columns are needed, so we don't build a dict for every row
+    with open(csvfile, newline='') as fd:
+        rows = reader(fd)
+        header = next(rows)
+        pcs_id_col, doi_col = header.index('PCS_ID'), header.index('DOI')
+        return {row[pcs_id_col]: row[doi_col] for row in rows}
 
 
-DOI = get_doi_list('./taps_procs.csv')
+@functools.lru_cache(maxsize=None)  # only read when the first DOI is checked
+def get_taps_dois():
+    try:
+        return get_doi_list('./taps_procs.csv')
+    except FileNotFoundError:
+        print("Warning: ./taps_procs.csv not found - DOIs cannot be checked")
+        return {}
 
 
 # works semi-reliably - if it finds a wrong DOI, it is usually right
 def check_pdf_doi(data):
     pcs_id = data['pcs_id']
-    if pcs_id not in DOI:
+    taps_doi = get_taps_dois().get(pcs_id)
+    if taps_doi is None:
         return(f"DOI for PCS ID {pcs_id} unknown")
-    if data['pdf_info']['DOI'] != DOI[pcs_id]:
-        if len(data['pdf_info']['DOI'].strip()) == 0:
-            return(f"DOI might be missing in PDF. DOI in HTML file: {DOI[pcs_id]}")
+    pdf_doi = data['pdf_info']['DOI']
+    if pdf_doi != taps_doi:
+        if len(pdf_doi.strip()) == 0:
+            return(f"DOI might be missing in PDF. DOI in HTML file: {taps_doi}")
         else:
-            return(f"DOI might be wrong in PDF: {data['pdf_info']['DOI']} vs. {DOI[pcs_id]}")
+            return(f"DOI might be wrong in PDF: {pdf_doi} vs. {taps_doi}")
 
 
 # works reliably
 def check_line_length(data):
-    line_lengths = [len(line) for line in data['pdf_text'].splitlines()]
-    line_count = len(line_lengths)
-    median = sorted(line_lengths)[line_count//2]
+    # lines only have a few hundred distinct lengths, so the median is taken from a histogram instead of sorting all lengths
+    line_lengths = Counter(len(line) for line in iter_lines(data['pdf_text']))
+    remaining = sum(line_lengths.values()) // 2  # index of the median in the sorted lengths (upper median for even counts)
+    median = 0
+    for median in sorted(line_lengths):
+        remaining -= line_lengths[median]
+        if remaining < 0:
+            break
     # print(f"Median line length: {median}")
     if median > 60 + 20:  # median line length in two columns: 60 - 65 chars
         return f"Single-column format or incorrectly tagged PDF (median line length is {median})."
@@ -361,6 +429,8 @@ def check_differences_title(data):
     ht = data['html_info']['TITLE'].strip()
     pt = data['pdf_info']['TITLE'].strip()
     pt = pt[0:min(len(pt), len(ht))]  # pdf title sometimes contains content from next line
+    if ht == pt:  # the usual case
+        return
     ht_clean = ht.replace("’", "'").replace('“', '"').replace('”', '"')
     pt_clean = pt.replace("’", "'").replace('“', '"').replace('”', '"')
     if ht_clean != pt_clean:
@@ -369,6 +439,8 @@ def check_differences_title(data):
 
 # quite reliable - some false positives
 def check_email(data):
+    if "@" not in data['pdf_text']:  # no need to look at the authors
+        return "None of the authors has an email address given!"
     authors = data['pdf_info']['AUTHORS']
     num_authors = data['pdf_info']['AUTHOR COUNT']
     emails = 0
@@ -383,10 +455,78 @@ def check_email(data):
         #return f"Only {emails}/{num_authors} authors have an email address!"
 
 
-CHECKS = [check_embedded_files, check_line_length, check_differences_title, check_email, 
-          check_ligatures_fi, check_ligatures_ff, check_ligatures_qu, check_pdf_creator, 
+CHECKS = (check_embedded_files, check_line_length, check_differences_title, check_email, 
+          check_ligatures, check_pdf_creator, 
           check_differences_reference_count, check_pdf_doi, check_form_fields, 
-          check_pdf_difference_taps_pdf, check_pdf_size]
+          check_pdf_difference_taps_pdf, check_pdf_size)
+
+
+# text extraction library used by each PDF_TEXT_BACKEND
+PDF_TEXT_BACKEND_PACKAGES = {"pdfminer": "pdfminer.six", "pypdfium2": "pypdfium2", "pymupdf": "PyMuPDF"}
+
+def package_version(package):
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return "missing"
+
+
+@functools.lru_cache(maxsize=None)
+def cache_prefix():
+    """Starts the name of every cache file. It changes whenever the cached results might change:
+    when this script is modified, or the text backend or one of the extraction libraries is replaced."""
+    packages = ("pdfminer.six", "lxml", PDF_TEXT_BACKEND_PACKAGES.get(PDF_TEXT_BACKEND, PDF_TEXT_BACKEND))
+    stamp = ":".join([str(os.stat(__file__).st_mtime_ns), PDF_TEXT_BACKEND] + [f"{package} {package_version(package)}" for package in packages])
+    return hashlib.blake2b(stamp.encode(), digest_size=8).hexdigest()
+
+
+def clean_cache():
+    """Removes the cache files of other script/library versions (and temporary files of aborted runs)."""
+    if not USE_CACHE or not os.path.isdir(CACHE_DIR):
+        return
+    prefix = f"{cache_prefix()}-"
+    for entry in os.scandir(CACHE_DIR):
+        if not (entry.name.startswith(prefix) and entry.name.endswith(".pickle")):
+            os.remove(entry.path)
+
+
+def cached(kind, path, compute):
+    """Returns compute() for the given file, cached on disk.
+    Cached results are ignored once the file has been modified - they are replaced by the new result."""
+    if not USE_CACHE:
+        return compute()
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    key = hashlib.blake2b(f"{kind}:{os.path.abspath(path)}".encode(), digest_size=16).hexdigest()
+    cache_file = f"{CACHE_DIR}/{cache_prefix()}-{key}.pickle"
+    try:
+        with open(cache_file, 'rb') as fd:
+            cached_stamp, result = pickle.load(fd)
+        if cached_stamp == stamp:
+            return result
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+    result = compute()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(f"{cache_file}.{os.getpid()}", 'wb') as fd:  # several workers may write at the same time
+        pickle.dump((stamp, result), fd)
+    os.replace(f"{cache_file}.{os.getpid()}", cache_file)
+    return result
+
+
+def link_file(src, destination_dir):
+    """Puts src into destination_dir without duplicating its content: as a hard link if possible,
+    as a symlink across file systems, as a copy if neither is supported."""
+    destination = os.path.join(destination_dir, os.path.basename(src))
+    if os.path.lexists(destination):  # from an earlier run - might be an older version of the file
+        os.remove(destination)
+    try:
+        os.link(src, destination)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(src), destination)
+        except OSError:
+            shutil.copy2(src, destination)
 
 
 def lint(pdf_file):
@@ -394,7 +534,7 @@ def lint(pdf_file):
     data = {}
     data["pdf_file"] = pdf_file
     try:
-        pcs_id = re.findall(r'[a-z]+[0-9]+', pdf_file.split("/")[-1])[0]
+        pcs_id = PCS_ID_RE.findall(pdf_file.split("/")[-1])[0]
         data["pcs_id"] = pcs_id
     except:
         print(f"{pdf_file}: PCS ID could not be extracted")
@@ -415,21 +555,25 @@ def lint(pdf_file):
     except:
         print(f"Warning: {pdf_file} ({pcs_id}): TAPS PDF file not found - aborting")
         raise RuntimeError("TAPS PDF not found")
-    data["pdf_text"] = extract_text(pdf_file)
-    data["pdf_info"] = get_info_from_pdf(pdf_file)
-    data["pdf_catalog"] = get_pdf_catalog(pdf_file)
-    data["html_text"] = extract_html_text(html_file)
-    data["html_info"] = get_info_from_html(html_file)
-
-    errors = {}
-    for check in CHECKS:
-        error = check(data)
-        errors[check.__name__] = error
-        if SORT_FILES and error:
-            destination_dir = f"{OUTPUT_DIR}/{check.__name__}_failed"
+    # open and parse the PDF only once - the PDFDocument reads objects lazily, so the file stays open until all checks are done
+    with open(pdf_file, 'rb') as pdf_fp:
+        data["pcs_size"] = os.fstat(pdf_fp.fileno()).st_size  # file sizes are determined only once for all checks
+        data["taps_size"] = os.stat(taps_pdf_file).st_size
+        pdf_doc = PDFDocument(PDFParser(pdf_fp))
+        def pdf_text_and_info():
+            text = extract_pdf_text(pdf_fp)  # both backends seek before reading, so the handle can be shared
+            return text, get_info_from_pdf(pdf_file, text=text, doc=pdf_doc)
+        data["pdf_text"], data["pdf_info"] = cached(f"pdf-{PDF_TEXT_BACKEND}", pdf_file, pdf_text_and_info)
+        data["pdf_catalog"] = pdf_doc.catalog
+        data["html_info"], data["html_text"] = cached("html", html_file, lambda: get_info_from_html(html_file))
+
+        errors = {check.__name__: check(data) for check in CHECKS}
+    failed = {typ: message for typ, message in errors.items() if message}
+    if SORT_FILES:
+        for typ in failed:
+            destination_dir = f"{OUTPUT_DIR}/{typ}_failed"
             os.makedirs(destination_dir, exist_ok=True)
-            shutil.copy2(pdf_file, destination_dir)
-    
+            link_file(pdf_file, destination_dir)
 
     # only check that needs pcs_id
     #errors["check_pdf_doi"] = check_pdf_doi(html_info, html_text, pdf_info, pdf_text, pcs_id)
@@ -439,10 +583,9 @@ def lint(pdf_file):
     #errors["check_pdf_difference_taps_pdf"] = check_pdf_difference_taps_pdf(pdf_file, taps_pdf_file)
     # only check that needs only PCS PDF
     #errors["check_pdf_size"] = check_pdf_size(pdf_file)
-    if any(errors.values()):
-        for typ, message in errors.items():
-            if message:
-                print(f"{pcs_id}: {typ}: {message}")
+    if failed:
+        for typ, message in failed.items():
+            print(f"{pcs_id}: {typ}: {message}")
     else:
         print(f"#{pcs_id}: OK!")
     errors["PCS ID"] = pcs_id  #   hand id back to calling function
@@ -451,38 +594,50 @@ def lint(pdf_file):
     return(errors)  
 
 
-if len(sys.argv) < 2:
-    print("Please provide PDF directory as parameter")
-    sys.exit(1)
-
-HTML_DIR = "./TAPS_HTML"
-# html_files = glob.glob(f'{HTML_DIR}/*.html') # currently we only iterate over the PDF files
-TAPS_PDF_DIR = "./TAPS_PDF"
-
-PDF_DIR = None  # also use as flag for whether we check a whole dir
-
-if len(sys.argv) == 2 and not sys.argv[1].endswith(".pdf"):  # directory given
-    PDF_DIR = f"{sys.argv[1]}"
-    pdf_files = sorted(glob.glob(f'{PDF_DIR}/*.pdf'))
-    if len(pdf_files) == 0:
-        print(f"No PDF files found in {PDF_DIR}.")
+def lint_file(pdf_file):
+    # runs in a worker process: collect the output so that the logs of different files do not get mixed up
+    output = io.StringIO()
+    with redirect_stdout(output):
+        try:
+            errors = lint(pdf_file)
+            if errors is None:  # no PCS ID in the file name, nothing was checked
+                errors = {'PDF file': pdf_file}
+            print("")
+        except Exception as e:
+            print(f'{pdf_file} couldn\'t be to automatically checked: ', end="")
+            print(e)
+            errors = {'PDF file': pdf_file}
+    return errors, output.getvalue()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Please provide PDF directory as parameter")
         sys.exit(1)
-else:  # individual files given
-    pdf_files = sys.argv[1:]
-
 
-print("# I'm linting!")
-error_list = []
-for pdf_file in tqdm(pdf_files):
-    try:
-        error_list.append(lint(pdf_file))
-        print("")
-    except Exception as e:
-        print(f'{pdf_file} couldn\'t be to automatically checked: ', end="")
-        print(e)
-        error_list.append({'PDF file': pdf_file})
-    if PDF_DIR:
-        with open(f"{PDF_DIR.strip('/').replace('/','_')}.lint.csv", 'w') as fd:
-            dw = DictWriter(fd, error_list[0].keys(), restval='x')
-            dw.writeheader()
-            dw.writerows(error_list)
+    PDF_DIR = None  # also use as flag for whether we check a whole dir
+
+    if len(sys.argv) == 2 and not sys.argv[1].endswith(".pdf"):  # directory given
+        PDF_DIR = f"{sys.argv[1]}"
+        pdf_files = sorted(glob.glob(f'{PDF_DIR}/*.pdf'))
+        if len(pdf_files) == 0:
+            print(f"No PDF files found in {PDF_DIR}.")
+            sys.exit(1)
+    else:  # individual files given
+        pdf_files = sys.argv[1:]
+
+
+    print("# I'm linting!")
+    get_taps_dois()  # read once here, so that the worker processes inherit it
+    clean_cache()
+    # the CSV is only written when a whole directory is checked
+    csv_file = f"{PDF_DIR.strip('/').replace('/','_')}.lint.csv" if PDF_DIR else os.devnull
+    fieldnames = [check.__name__ for check in CHECKS] + ["PCS ID", "PDF file", "Title"]
+    # PDFs are checked in parallel (one process per CPU core), imap() keeps results in the order of pdf_files
+    with open(csv_file, 'w') as fd, Pool() as pool:
+        dw = DictWriter(fd, fieldnames, restval='x')
+        dw.writeheader()
+        for errors, output in tqdm(pool.imap(lint_file, pdf_files), total=len(pdf_files)):
+            print(output, end="")
+            dw.writerow(errors)
+            fd.flush()  # partial results are kept if the run is aborted
@@ -9,13 +9,19 @@ import re
 import os
 import time
 import sys
+import json
+import threading
 from csv import DictReader
-from urllib.request import urlopen, urlretrieve, HTTPError
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 import getpass
 
 # additional dependencies
 import click
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 
 
@@ -36,6 +42,33 @@ PCS_SPREADSHEET_URL_PREFIX = "https://new.precisionconference.com/"
 PCS_SPREADSHEET_URL_SUFFIX = "/pubchair/csv/camera"
 LIST_FILE_SUFFIX = "_camera_ready.csv"
 FIELDS_FILE_SUFFIX = "_fields.csv"
+CSRF_TOKEN_PREFIX = 'name="csrf_token" type="hidden" value="'
+TRACK_LINK_RE = re.compile(r'<a href="/(\w+)/(\w+)">(.+)</a>')  # track/role link in the track list
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-\d+/(\d+)")
+DOWNLOAD_CACHE_SUFFIX = "_downloads.json"  # ETag/Last-Modified/size of each downloaded file
+DOWNLOAD_WORKERS = 8  # number of files downloaded in parallel
+DOWNLOAD_CHUNK_SIZE = 1024*1024  # bytes read from the network per write
+
+class ServerErrorRetry(Retry):
+    # urllib3 would otherwise retry any 429 with a Retry-After header itself, bypassing the per-host throttle below
+    RETRY_AFTER_STATUS_CODES = Retry.RETRY_AFTER_STATUS_CODES - {429}
+
+# Transient server errors are retried with exponential backoff (1, 2, 4, ... s, or Retry-After).
+# 429 is never retried here as it is handled per host by rate_limited_request().
+SERVER_ERROR_RETRIES = ServerErrorRetry(total=8, backoff_factor=1.0, status_forcelist=(500, 502, 503, 504),
+                                        respect_retry_after_header=True)
+
+# A single session is used for logging in and for all file downloads so that
+# connections (and TLS sessions) are reused instead of opening one per file.
+pcs_session = requests.Session()
+pcs_session.mount("https://", HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS, max_retries=SERVER_ERROR_RETRIES))
+
+# If a server answers with '429 Too Many Requests', all workers pause requests to that host
+# for the time given in the Retry-After header (or an exponentially growing backoff).
+RATE_LIMIT_RETRIES = 5
+RATE_LIMIT_BACKOFF = 2  # seconds, doubled on every retry
+throttled_hosts = {}  # host -> time.time() before which no requests are sent to it
+throttle_lock = threading.Lock()
 
 
 def file_is_current(file_path, max_seconds=300):
@@ -44,18 +77,23 @@ def file_is_current(file_path, max_seconds=300):
     return (current_time - file_mtime) < max_seconds
 
 
+def get_csrf_token(html):
+    # the token is the value of a fixed hidden input field, no need to run a regex over the whole page
+    start = html.index(CSRF_TOKEN_PREFIX) + len(CSRF_TOKEN_PREFIX)
+    return html[start:html.index('"', start)]
+
+
 def get_available_tracks(user, password, print_them=False):
     print("Getting list of tracks ... ")
-    pcs_session = requests.Session()
     r = pcs_session.get(PCS_LOGIN_URL)
-    csrf_token = re.search(r'name="csrf_token" type="hidden" value="([a-z0-9#]+)"', r.text).groups()[0]
+    csrf_token = get_csrf_token(r.text)
     r = pcs_session.post(PCS_LOGIN_URL, data={'username': user, 'password': password, 'csrf_token': csrf_token})
     r = pcs_session.get(PCS_TRACK_LIST_URL)
     roles = r.json()['data']
     available_tracks = {}
     for role in roles:
         title = role[0]
-        match = re.match(r'<a href="/(\w+)/(\w+)">(.+)</a>', role[3])
+        match = TRACK_LINK_RE.match(role[3])
         track_id = match.group(1)
         role_id = match.group(2)
         track_name = match.group(3)
@@ -80,13 +118,15 @@ def get_camera_ready_csv(track_id, user, password, overwrite=True):
         print("file already downloaded less than five minutes ago - skipping download")
         return
     print("Downloading camera_ready.csv ... ")
-    pcs_session = requests.Session()
     r = pcs_session.get(PCS_LOGIN_URL)
-    csrf_token = re.search(r'name="csrf_token" type="hidden" value="([a-z0-9#]+)"', r.text).groups()[0]
+    csrf_token = get_csrf_token(r.text)
     r = pcs_session.post(PCS_LOGIN_URL, data={'username': user, 'password': password, 'csrf_token': csrf_token})
-    r = pcs_session.get(PCS_SPREADSHEET_URL_PREFIX + track_id + PCS_SPREADSHEET_URL_SUFFIX)
-    with open(list_file, "wb") as fd:
-        fd.write(r.content)
+    # streamed to disk; the temporary file keeps an interrupted download from being taken for a current list
+    with pcs_session.get(PCS_SPREADSHEET_URL_PREFIX + track_id + PCS_SPREADSHEET_URL_SUFFIX, stream=True) as r, \
+         open(list_file + ".part", "wb") as fd:
+        for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+            fd.write(chunk)
+    os.replace(list_file + ".part", list_file)
     print("done.")
 
 
@@ -103,106 +143,223 @@ def get_filetypes(typefile):
         sys.exit(1)
 
 
-def download_file(paper_id, url, filename, overwrite="modified"):
+def wait_for_host(host):
+    with throttle_lock:
+        delay = throttled_hosts.get(host, 0) - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def throttle_host(host, seconds):
+    with throttle_lock:
+        throttled_hosts[host] = max(throttled_hosts.get(host, 0), time.time() + seconds)
+
+
+def rate_limited_request(method, url, **kwargs):
+    host = urlsplit(url).netloc
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        wait_for_host(host)
+        r = pcs_session.request(method, url, **kwargs)
+        if r.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+            return r
+        r.close()
+        try:
+            delay = int(r.headers["Retry-After"])
+        except (KeyError, ValueError):  # missing or given as HTTP date
+            delay = RATE_LIMIT_BACKOFF * 2**attempt
+        tqdm.write(f"    rate limited by {host} - pausing for {delay} s")
+        throttle_host(host, delay)
+
+
+# The download cache maps each downloaded filename to the validators the server sent for it
+# ({"etag": ..., "last_modified": ..., "size": ...}) so that unchanged files can be skipped on the next run.
+
+def load_download_cache(track_id):
     try:
-        doc = None
+        with open(f"{track_id}{DOWNLOAD_CACHE_SUFFIX}") as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_download_cache(track_id, cache):
+    with open(f"{track_id}{DOWNLOAD_CACHE_SUFFIX}", "w") as fd:
+        json.dump(cache, fd, indent=1)
+
+
+def is_unchanged(headers, known, file_size):
+    if int(headers.get("Content-Length", -1)) != file_size:
+        return False
+    # files downloaded before the cache existed can only be compared by size
+    for key, header in [('etag', "ETag"), ('last_modified', "Last-Modified")]:
+        if known.get(key) and headers.get(header) and known[key] != headers[header]:
+            return False
+    return True
+
+
+def download_file(paper_id, url, filename, overwrite="modified", cache=None):
+    if cache is None:
+        cache = {}
+    try:
+        head = None
+        request_headers = {}
+        try:  # a single stat() tells us whether the file exists and how large it is
+            file_size = os.path.getsize(filename)
+        except FileNotFoundError:
+            file_size = None
         # avoid unnecessary downloads
         if overwrite == "none":
-            if os.path.exists(filename):  # only download if file changed
-                tqdm.write("   >... already downloaded")
+            if file_size is not None:  # only download if file changed
+                tqdm.write(f"   >{paper_id}: already downloaded")
+                return True
+        elif overwrite == "modified" and file_size is not None:  # only download if file changed
+            known = cache.get(filename, {})
+            # HEAD only transfers the headers, which is all we need to decide whether to download
+            head = rate_limited_request("HEAD", url, allow_redirects=True, timeout=10)
+            if head.ok and is_unchanged(head.headers, known, file_size):
+                tqdm.write(f"   >{paper_id}: already downloaded")
+                return True
+            validator = known.get('etag') or known.get('last_modified')
+            if validator and file_size < known.get('size', 0):
+                # interrupted download: only ask for the missing bytes. If-Range makes the server send
+                # the whole file instead if it has changed in the meantime.
+                request_headers['Range'] = f"bytes={file_size}-"
+                request_headers['If-Range'] = validator
+            elif not head.ok:  # some servers refuse HEAD requests - let the server decide via a conditional GET
+                if known.get('etag'):
+                    request_headers['If-None-Match'] = known['etag']
+                if known.get('last_modified'):
+                    request_headers['If-Modified-Since'] = known['last_modified']
+        doc = rate_limited_request("GET", url, headers=request_headers, stream=True, timeout=10)
+        if doc.status_code == 304:  # not modified
+            doc.close()
+            tqdm.write(f"   >{paper_id}: already downloaded")
+            return True
+        doc.raise_for_status()
+        offset = 0
+        if doc.status_code == 206:  # partial content: "Content-Range: bytes <start>-<end>/<total>"
+            content_range = CONTENT_RANGE_RE.match(doc.headers.get("Content-Range", ""))
+            if content_range and int(content_range.group(1)) == file_size:
+                offset = file_size
+                doc_size = int(content_range.group(2))
+                tqdm.write(f"   >{paper_id}: resuming download at {offset/1000000.0:.2f} MB")
+            else:  # not what we asked for - start over
+                doc.close()
+                doc = rate_limited_request("GET", url, stream=True, timeout=10)
+                doc.raise_for_status()
+        if offset == 0:
+            doc_size = int(doc.headers["Content-Length"])
+            if head is not None and not head.ok and is_unchanged(doc.headers, known, file_size):
+                doc.close()
+                tqdm.write(f"   >{paper_id}: already downloaded")
                 return True
-        elif overwrite == "modified":
-            doc = urlopen(url, timeout=10)
-            doc_size = int(doc.getheader("Content-Length"))
-            if os.path.exists(filename):  # only download if file changed
-                file_size = os.stat(filename).st_size
-                if file_size == doc_size:
-                    tqdm.write("   >... already downloaded")
-                    return True
-        # ok, we want to download the file. make request if not already done
-        if not doc:
-            doc = urlopen(url, timeout=10)
-            doc_size = int(doc.getheader("Content-Length"))
-        with open(filename, 'wb') as fd:
+        # remember the validators before writing so that an interrupted download can be resumed
+        previous = known if offset else {}  # a 206 response need not repeat the validators
+        cache[filename] = {'etag': doc.headers.get("ETag", previous.get('etag')),
+                           'last_modified': doc.headers.get("Last-Modified", previous.get('last_modified')),
+                           'size': doc_size}
+        with doc, open(filename, 'ab' if offset else 'wb') as fd:
             #print(f" ({doc_size/1000000.0:.2f} MB)")
-            progress_bar = tqdm(total=doc_size, unit='iB', unit_scale=True, leave=False)
-            while True:
-                data = doc.read(1024*100)
-                if not data:
-                    break
+            progress_bar = tqdm(total=doc_size, initial=offset, unit='iB', unit_scale=True, leave=False)
+            for data in doc.iter_content(DOWNLOAD_CHUNK_SIZE):
                 fd.write(data)
                 progress_bar.update(len(data))
             progress_bar.close()
-            return True
-    except (ValueError, HTTPError) as e:
-        tqdm.write("   >... file not found on server")
+        return True
+    except requests.exceptions.RetryError as e:
+        tqdm.write(f"   >{paper_id}: SERVER ERROR - giving up after {SERVER_ERROR_RETRIES.total} retries")
+        print(e)
+        return False
+    except (ValueError, KeyError, requests.RequestException, urllib3.exceptions.HTTPError) as e:
+        tqdm.write(f"   >{paper_id}: file not found on server")
         print(e)
         return False
 
 
+def download_submission(track_id, idx, submission, filetypes, overwrite="modified", cache=None):
+    paper_id = submission['Paper ID']
+    tqdm.write(f"[{idx}] Paper: {paper_id} ({submission['Title']})")
+    for filetype in filetypes:
+        if len(submission[filetype['pcs_field']]) > 1:
+            tqdm.write(f"    {paper_id}: Retrieving '{filetype['description']}'")
+            filename = f"{track_id}_{filetype['directory']}/{paper_id}{filetype['suffix']}"
+            url = submission[filetype['pcs_field']]
+            if not download_file(paper_id, url, filename, overwrite, cache):
+                tqdm.write(f"    {paper_id}: failed")
+                return False
+        else:
+            tqdm.write(f"   >{paper_id}: '{filetype['description']}' not submitted")
+    return True
+
+
+def existing_filetypes(filetypes, fieldnames):
+    # checked once per CSV instead of once per submission
+    for filetype in filetypes:
+        if filetype['pcs_field'] not in fieldnames:
+            print(f"field {filetype['pcs_field']} not in CSV - skipping '{filetype['description']}'")
+    return [filetype for filetype in filetypes if filetype['pcs_field'] in fieldnames]
+
+
 # overwrite: 
 # "all" download files regardless of whether they already exist
-# "modified" get HTTP header for each file and only downloade existing files if local file size is different than server file size.
+# "modified" get HTTP header for each file and only downloade existing files if local file size (or ETag/Last-Modified) is different than on the server.
 # "none" only download files that do not already exist locally (this misses files that have been modified recently but is faster than checking file sizes
+#
+# Submissions are downloaded in parallel (workers at a time). If any download fails, the index of the
+# first failed submission is returned so that the caller can refresh the (expired) download links and resume there.
 
-def download_files(track_id, filetypes, start_index=0, overwrite="modified"):
+def download_files(track_id, filetypes, start_index=0, overwrite="modified", workers=DOWNLOAD_WORKERS):
     for filetype in filetypes:
-        try:
-            os.makedirs(f"{track_id}_{filetype['directory']}")
-        except FileExistsError:
-            print(f"directory '{track_id}_{filetype['directory']}' already exists, writing into it")
+        os.makedirs(f"{track_id}_{filetype['directory']}", exist_ok=True)
 
-    fd = open(f"{track_id}{LIST_FILE_SUFFIX}", encoding='utf-8-sig')  # CSV has BOM
-    submissions = list(DictReader(fd))  # load in memory so that we get the line count
-    for idx, submission in enumerate(tqdm(submissions, desc="Submissions processed", leave=False)):
-        tqdm.write(f"[{idx}] Paper: {submission['Paper ID']} ({submission['Title']})")
-        if idx < start_index:
-            tqdm.write("    skipping")
-            continue
-        for filetype in filetypes:
-            try:
-                if len(submission[filetype['pcs_field']]) > 1:
-                    tqdm.write(f"    Retrieving '{filetype['description']}'")
-                    paper_id = submission['Paper ID']
-                    filename = f"{track_id}_{filetype['directory']}/{paper_id}{filetype['suffix']}"
-                    url = submission[filetype['pcs_field']]
-                    if download_file(paper_id, url, filename, overwrite):
-                        pass 
-                        #print("done")
-                    else:
-                        tqdm.write("failed")
-                        return idx
-                else:
-                    tqdm.write(f"   >... '{filetype['description']}' not submitted")
-            except KeyError:
-                tqdm.write(f"   >... field {filetype['pcs_field']} not in CSV")
-    fd.close()
+    cache = load_download_cache(track_id)
+    # Rows are handed to the workers as they are read. The semaphore keeps the CSV reader at most a few rows
+    # ahead of the downloads so that we never hold all submissions in memory.
+    pending = threading.BoundedSemaphore(2 * workers)
+    try:
+        # CSV has BOM
+        with open(f"{track_id}{LIST_FILE_SUFFIX}", encoding='utf-8-sig') as fd, \
+             ThreadPoolExecutor(max_workers=workers) as executor:
+            submissions = DictReader(fd)
+            filetypes = existing_filetypes(filetypes, submissions.fieldnames or [])
+            futures = {}
+            for idx, submission in enumerate(tqdm(submissions, desc="Submissions processed", leave=False)):
+                if idx < start_index:
+                    tqdm.write(f"[{idx}] Paper: {submission['Paper ID']} ({submission['Title']})")
+                    tqdm.write("    skipping")
+                    continue
+                pending.acquire()
+                future = executor.submit(download_submission, track_id, idx, submission, filetypes, overwrite, cache)
+                future.add_done_callback(lambda future: pending.release())
+                futures[future] = idx
+        failed = [idx for future, idx in futures.items() if not future.result()]
+    finally:
+        save_download_cache(track_id, cache)
+    if failed:
+        return min(failed)
 
 
 def print_status(track_id, filetypes, verbose=False):
     if len(filetypes) == 0:
         sys.exit()
+    fd = open(f"{track_id}{LIST_FILE_SUFFIX}", encoding='utf-8-sig')  # CSV has BOM
+    submissions = DictReader(fd)
+    filetypes = existing_filetypes(filetypes, submissions.fieldnames or [])
     missing = {}
     for filetype in filetypes:
         missing[filetype['description']] = []
-    fd = open(f"{track_id}{LIST_FILE_SUFFIX}", encoding='utf-8-sig')  # CSV has BOM
-    submissions = DictReader(fd)
     for idx, submission in enumerate(submissions):
         if verbose:
             print(f"[{idx}] Paper: {submission['Paper ID']} ({submission['Title']})")
+        paper_id = submission['Paper ID']
         for filetype in filetypes:
-            try:
-                doi = submission['DOI'].split("/")[-1]  # https://doi.org/10.1145/3491102.3501897 -> 3491102.3501897
-                paper_id = submission['Paper ID']
-                if len(submission[filetype['pcs_field']]) < 1:
-                    if verbose:
-                        print(f"   >... '{filetype['description']}' not submitted")
-                    missing[filetype['description']].append(paper_id)
-                else:
-                    if verbose:
-                        print(f"   >... '{filetype['description']}' submitted")
-            except KeyError:
-                print(f"   >... field {filetype['pcs_field']} not in CSV")
+            if len(submission[filetype['pcs_field']]) < 1:
+                if verbose:
+                    print(f"   >... '{filetype['description']}' not submitted")
+                missing[filetype['description']].append(paper_id)
+            else:
+                if verbose:
+                    print(f"   >... '{filetype['description']}' submitted")
     fd.close()
     for filetype in filetypes:
         print(f"'{filetype['description']}' ({track_id}) still missing:")
@@ -270,13 +427,14 @@ def create_fields_file(track_id, fields_file):
 @click.option('--user', prompt=True, help='PCS user (can also be set via environment variable PCS_USER)')
 @click.option("--password", prompt=True, help='PCS password (can also be set via environment variable PCS_PASSWORD)', hide_input=True)
 @click.option('--overwrite', type=click.Choice(['all', 'none', 'modified']), default='modified', help="all: always overwrite; none: never overwrite; modified: overwrite if file size has changed", show_default=True)
+@click.option('--jobs', default=DOWNLOAD_WORKERS, type=click.IntRange(min=1), help='number of files downloaded in parallel', show_default=True)
 @click.option('--start', 'start_index', default=0, help='start download at n-th line of CSV (good for resuming failed downloads')
 @click.option('--status', is_flag=True, default=False, help='only print status of submissions')
 @click.option('--tracks', is_flag=True, default=False, help='only print available tracks')
 @click.option('--guess_fields', is_flag=True, default=False, help='only try to automatically create a configuration file with fields for this track')
 @click.argument('track_id')
 @click.argument('dl_flags', nargs=-1)
-def download(track_id, dl_flags, overwrite, start_index, status, tracks, guess_fields, user, password):
+def download(track_id, dl_flags, overwrite, jobs, start_index, status, tracks, guess_fields, user, password):
     """This script downloads a spreadsheet of camera-ready submissions for a given track from PCS.
         Afterwards, it optionally downloads all final PDFs, videos and zip files with supplementary 
         materials which are linked in the spreadsheet.
@@ -343,8 +501,10 @@ def download(track_id, dl_flags, overwrite, start_index, status, tracks, guess_f
         return  # finished
 
     print(f"Downloading files for: {track_id}")
+    if jobs != DOWNLOAD_WORKERS:  # one pooled connection per worker
+        pcs_session.mount("https://", HTTPAdapter(pool_maxsize=jobs, max_retries=SERVER_ERROR_RETRIES))
     while True:  # reload camera-ready.csv on error
-        start_index = download_files(track_id, filetypes, start_index, overwrite=overwrite)
+        start_index = download_files(track_id, filetypes, start_index, overwrite=overwrite, workers=jobs)
         if start_index is None:   # finished
             break
         else:
@@ -11,23 +11,23 @@ src_dir = sys.argv[1]
 dst_dir = sys.argv[2] 
 
 CSV_FILE = "./taps_procs.csv"
-
-pcs_to_taps_id = {}
-taps_to_pcs_id = {}
+PCS_ID_RE = re.compile(r"([a-z]+\d+)\.pdf")  # matched against the file name, e.g. pn1234.pdf
+TAPS_ID_RE = re.compile(r"(\d+)\.pdf")  # e.g. 12.pdf
 
 with open(CSV_FILE) as fd:
-    dr = DictReader(fd)
-    for paper in dr:
-        pcs_to_taps_id[paper['PCS_ID']] = paper['PAPER ID']
-        taps_to_pcs_id[paper['PAPER ID']] = paper['PCS_ID']
+    papers = [(paper['PCS_ID'], paper['PAPER ID']) for paper in DictReader(fd)]
+# built independently: several TAPS papers may share a PCS ID (e.g., an empty one)
+pcs_to_taps_id = {pcs_id: taps_id for pcs_id, taps_id in papers}
+taps_to_pcs_id = {taps_id: pcs_id for pcs_id, taps_id in papers}
 
 os.makedirs(dst_dir, exist_ok=True)
 
-for f in glob.glob(f"{src_dir}/*.pdf"):
-    pcs_id = re.match(r"^.*\/([a-z]+\d+)\.pdf", f)
+for f in glob.iglob(f"{src_dir}/*.pdf"):
+    filename = os.path.basename(f)
+    pcs_id = PCS_ID_RE.match(filename)
     if pcs_id:
         pcs_id = pcs_id.group(1)
-    taps_id = re.match(r"^.*\/(\d+)\.pdf", f)
+    taps_id = TAPS_ID_RE.match(filename)
     if taps_id:
         taps_id = taps_id.group(1)
     assert(not (taps_id and pcs_id))
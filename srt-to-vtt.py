@@ -2,12 +2,21 @@
 
 import webvtt
 import sys
+from multiprocessing import Pool
 
-for f in sys.argv[1:]:
+
+def convert(f):
     try:
-        print(f)
         w = webvtt.from_srt(f)
         w.save()
     except webvtt.errors.MalformedFileError:
-        print("Malformed file, skipping!")
+        return "Malformed file, skipping!"
+
 
+if __name__ == "__main__":
+    # files are converted in parallel (one process per CPU core), imap() keeps the output in the order of the arguments
+    with Pool() as pool:
+        for f, error in zip(sys.argv[1:], pool.imap(convert, sys.argv[1:], chunksize=8)):
+            print(f)
+            if error:
+                print(error)
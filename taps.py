@@ -7,7 +7,9 @@ INFO = """This script downloads a spreadsheet of submissions from TAPS.
 Afterwards, it optionally downloads all final PDFs and HTML files (but no media linked in the HTML).
 To do this, pass parameters `--all`, `--pdf`, `--html`, or a combination of these.
 
-Adjust the TAPS ID to match your conference. 
+Pass the proceedings ID of your conference via `--conf-id` or the environment variable CONF_ID.
+TAPS credentials are read from --user/--password, the environment variables TAPS_USER/TAPS_PASSWORD,
+or a `~/.netrc` entry for camps.aptaracorp.com (you are only prompted for them if none of these is set).
 
 The downloaded spreadsheet is called `taps_procs.csv`.
 Files are stored in folders ./TAPS_PDF/ and ./TAPS_HTML/ .
@@ -19,35 +21,71 @@ ATTENTION: existing files are overwritten.
 
 ##################################
 
-print(INFO)
-
 # stdlib
 from lxml import etree
 import re
 import time
 import os
 import sys
-from csv import DictWriter, DictReader
-import getpass
-from urllib.request import urlopen, urlretrieve, HTTPError
+from csv import writer, DictReader
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import queue
+import netrc
+import http.cookiejar
+import threading
+import itertools
+import json
+import shutil
 
 # additional
+import click
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from tqdm import tqdm
 print = tqdm.write
 
 
-CONF_ID = os.environ.get('CONF_ID') or input("Conference ID: ")
+TAPS_HOST = 'camps.aptaracorp.com'  # also the machine name looked up in ~/.netrc
 SESSION_PAGE = 'https://camps.aptaracorp.com/ACMConference/'
 LOGIN_PAGE = 'https://camps.aptaracorp.com/ACMConference/login.html'
-METADATA_PAGE = 'https://camps.aptaracorp.com/ACMConference/showpaperdetails.html?proceeding_ID=' + CONF_ID + '&paper_Id='
-METADATA_SPREADSHEET = 'https://camps.aptaracorp.com/ACMConference/downloadmetadata.html?proceedingId=' + CONF_ID
-PROC_PAGE = 'https://camps.aptaracorp.com/ACMConference/showcopyrightpapers.html?proceeding_ID=' + CONF_ID + '&event_id=15896&workshop_id=0'
+# {conf_id} is the proceedings ID
+METADATA_PAGE = 'https://camps.aptaracorp.com/ACMConference/showpaperdetails.html?proceeding_ID={conf_id}&paper_Id={paper_id}'
+METADATA_SPREADSHEET = 'https://camps.aptaracorp.com/ACMConference/downloadmetadata.html?proceedingId={conf_id}'
+PROC_PAGE = 'https://camps.aptaracorp.com/ACMConference/showcopyrightpapers.html?proceeding_ID={conf_id}&event_id=15896&workshop_id=0'
 
-USER_LOGINNAME = os.environ.get('TAPS_USER') or input("TAPS user; ")
-PASSWORD = os.environ.get('TAPS_PASSWORD') or getpass.getpass("TAPS password: ")
 LIST_FILE = "taps_procs.csv"
+COOKIE_FILE = "taps_cookies.txt"  # TAPS login cookies; reused by runs within COOKIE_MAX_AGE seconds
+COOKIE_MAX_AGE = 20*60
+LOGIN_FORM_FIELD = 'user_loginname'  # only found on the login page
+METADATA_DIR = "TAPS_META"  # raw metadata pages are stored here with --keep-metadata
+DOWNLOAD_CACHE_FILE = "taps_downloads.json"  # ETag/Last-Modified/size of each downloaded file
+DOWNLOAD_CACHE_MAX_AGE = 300  # seconds for which files checked against the server are considered current
+DOWNLOAD_CACHE_SAVE_INTERVAL = 50  # number of files after which the download cache is saved during a run
+DOWNLOAD_WORKERS = 8  # default number of files downloaded in parallel, see --jobs
+METADATA_WORKERS = 16  # default number of metadata pages fetched in parallel, see --metadata-jobs
+DOWNLOAD_CHUNK_SIZE = 1024*1024  # bytes read from the network per write
+NOT_FOUND = (404, 410)  # status codes for files which are (no longer) on the server - not an error
+PAGE_CHUNK_SIZE = 64*1024  # bytes of the paper list fed to the HTML parser at once
+
+# Rate limits and transient server errors are retried with exponential backoff (1, 2, 4, ... s, or Retry-After)
+DOWNLOAD_RETRIES = Retry(total=8, backoff_factor=1.0, status_forcelist=(429, 500, 502, 503, 504),
+                         respect_retry_after_header=True)
+
+# one logged-in session is reused for the paper list, all metadata pages and all file downloads,
+# so that we don't open a new connection (and TLS handshake) per request
+session = requests.Session()
+session.cookies = http.cookiejar.MozillaCookieJar(COOKIE_FILE)  # saved by login() for the next run
+# metadata pages and files are fetched at the same time, +1 for the paper list
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=METADATA_WORKERS + DOWNLOAD_WORKERS + 1,
+                                      max_retries=DOWNLOAD_RETRIES))
+logged_in = False
+login_reused = False  # cookies of an earlier run are used
+login_lock = threading.Lock()
 
 
 # ############ Helper functions ##################
@@ -60,190 +98,435 @@ def file_is_current(file_path, max_seconds=300):
     return (current_time - file_mtime) < max_seconds
 
 
-def get_pdf(element):
-    try:
-        s = element.xpath("a/img[@title = 'PDF Open']")[0].attrib['onclick']
-        x = re.match(r".*openfile\(('.*')\)", s).groups()[0]
-        components = list(map(lambda s: s.strip("'"), x.split(',')))
-        url = "https://camps.aptaracorp.com/" + components[1] + "/" + components[2]
-    except IndexError: # no PDF link
-        url = ""
-    return url
-    
-def get_html(element):
-    try:
-        s = element.xpath("a/img[@title = 'View HTML']")[0].attrib['onclick']
-        x = re.match(r".*showhtml5\(('.*')\)", s).groups()[0]
-        components = list(map(lambda s: s.strip("'"), x.split(',')))
-        url = "https://camps.aptaracorp.com/" + components[1] + "/" + components[2]
-    except IndexError: # no PDF link
-        url = ""
-    return url
+# all links of a paper are images with an onclick handler in the ACTIONS cell
+ACTIONS_XPATH = etree.XPath("a/img")
+OPENFILE_RE = re.compile(r"openfile\(('.*')\)")
+SHOWHTML_RE = re.compile(r"showhtml5\(('.*')\)")
+ERRORLOG_RE = re.compile(r"showerrorlog\(('.*')\)")
+STATUS_RE = re.compile(r"[0-9]+")  # the status image is named after the percentage
+TEXT_XPATH = etree.XPath("normalize-space(.)", smart_strings=False)  # plain str, no reference to the tree
+
+
+def get_js_args(regex, onclick):
+    x = regex.search(onclick).groups()[0]
+    return [s.strip("'") for s in x.split(',')]
+
+def get_actions(element):
+    """Returns PDF, HTML, and error log URLs found in an ACTIONS cell ("" if missing)."""
+    urls = {"PDF_URL": "", "HTML_URL": "", "ERROR_URL": ""}
+    for img in ACTIONS_XPATH(element):
+        title = img.get('title')
+        if title == 'PDF Open' and not urls["PDF_URL"]:
+            components = get_js_args(OPENFILE_RE, img.get('onclick'))
+            urls["PDF_URL"] = "https://camps.aptaracorp.com/" + components[1] + "/" + components[2]
+        elif title == 'View HTML' and not urls["HTML_URL"]:
+            components = get_js_args(SHOWHTML_RE, img.get('onclick'))
+            urls["HTML_URL"] = "https://camps.aptaracorp.com/" + components[1] + "/" + components[2]
+        elif title == 'Error/Warning' and not urls["ERROR_URL"]:
+            proc_id, paper_id, strip_acronym, filename, uid = get_js_args(ERRORLOG_RE, img.get('onclick'))
+            urls["ERROR_URL"] = f"https://camps.aptaracorp.com/ACMConference/downloadpdf2.html?Proceeding_ID={proc_id}&Paper_ID={paper_id}&Strip_acronym={strip_acronym}&filename={filename}&uid={uid}&event_id=14600&workshop_id=0"
+    return urls
 
 def get_status(element):
-    img = element.getchildren()[0]
+    img = element[0]
     try:
-        percent = int(re.findall(r"[0-9]+", img.attrib['src'])[0])
+        percent = int(STATUS_RE.search(img.attrib['src']).group())
     except ValueError:
         percent = None
     return percent
 
-def get_error(element):
-    try:
-        s = element.xpath("a/img[@title = 'Error/Warning']")[0].attrib['onclick']
-        x = re.match(r".*showerrorlog\(('.*')\)", s).groups()[0]
-        components = list(map(lambda s: s.strip("'"), x.split(',')))
-        proc_id, paper_id, strip_acronym, filename, uid = components
-        url = f"https://camps.aptaracorp.com/ACMConference/downloadpdf2.html?Proceeding_ID={proc_id}&Paper_ID={paper_id}&Strip_acronym={strip_acronym}&filename={filename}&uid={uid}&event_id=14600&workshop_id=0"
-    except IndexError: # no error link
-        url = ""
-    return url
+
+# Each column of the paper table is converted by one of these (special cases: STATUS and ACTIONS)
+
+def set_status(d, col, cell):
+    d["STATUS"] = get_status(cell)
+
+def set_actions(d, col, cell):
+    d.update(get_actions(cell))
+
+def set_text(d, col, cell):
+    # all text within the cell - Aptara put some paper titles which start with '"' within a further "<blnk>" element
+    d[col] = TEXT_XPATH(cell)
+
+COLUMN_HANDLERS = {'STATUS': set_status, 'ACTIONS': set_actions}  # all other columns: set_text
+
+
+HEADER_XPATH = etree.XPath("th/div")
+DOWNLOAD_FIELDS = ("PAPER ID", "PCS_ID", "PDF_URL", "HTML_URL")  # all that download_files() needs of a paper
+
+
+def iter_paper_table(chunks):
+    """Yields the rows (<tr>) of the paper table (header first) while the HTML page is parsed incrementally
+    from an iterable of byte chunks. Each row is freed once the caller has processed it."""
+    parser = etree.HTMLPullParser(events=("end",), tag="tr")
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            parser.close()  # flushes the rows still buffered in the parser
+        else:
+            parser.feed(chunk)
+        for _, row in parser.read_events():
+            section = row.getparent()  # thead or tbody
+            if section is None or section.getparent() is None or section.getparent().get('id') != 'ce_data':
+                continue
+            yield row
+            row.clear()
+            while row.getprevious() is not None:
+                del section[0]
 
 
 # ########### functions #################
 
-def get_submissions(overwrite=True):
+def is_login_page(r):
+    # TAPS shows (or redirects to) its login form whenever the session is not logged in
+    return (bool(r.history) and r.url.startswith(LOGIN_PAGE)) or LOGIN_FORM_FIELD in r.text
+
+
+def forget_login():
+    global logged_in
+    session.cookies.clear()
+    if os.path.exists(COOKIE_FILE):
+        os.remove(COOKIE_FILE)
+    logged_in = False
+
+
+def login(user, password):
+    global logged_in, login_reused
+    with login_lock:  # the paper list and the downloads are started from different threads
+        if logged_in:
+            return
+        # the cookies of a recent login are usually still valid, so we can skip logging in again
+        reuse = False
+        if file_is_current(COOKIE_FILE, COOKIE_MAX_AGE):
+            try:
+                session.cookies.load(ignore_discard=True, ignore_expires=True)
+                reuse = True
+            except (OSError, http.cookiejar.LoadError):
+                session.cookies.clear()
+        r = session.get(SESSION_PAGE)
+        if reuse:
+            if not is_login_page(r):
+                print("Reusing TAPS login from last run")
+                logged_in = login_reused = True
+                return
+            forget_login()  # expired on the server - start a new session
+            r = session.get(SESSION_PAGE)
+        print("Logging in...")
+        # select_dashboard: 1 = Proceedings, 2 = PACM
+        r = session.post(LOGIN_PAGE, data={LOGIN_FORM_FIELD: user, 'password': password, 'select_dashboard': '1', 'button2': 'Login'})
+        if not r.ok or is_login_page(r):
+            sys.exit("TAPS login failed - please check user name and password")
+        session.cookies.save(ignore_discard=True, ignore_expires=True)  # TAPS uses session cookies
+        logged_in = True
+        login_reused = False
+
+
+def metadata_file(pcs_id, taps_id):
+    return f"{METADATA_DIR}/{pcs_id}_{taps_id}.html"
+
+
+def get_metadata(conf_id, paper, keep_metadata=False):
+    print(f"getting metadata for paper {paper['PAPER ID']} ({paper['TITLE']})")
+    text = session.get(METADATA_PAGE.format(conf_id=conf_id, paper_id=paper['PAPER ID'])).text
+    metadata = text.splitlines()
+    pcs_id, doi = metadata[9], metadata[12]
+    if keep_metadata:  # the raw page is only needed for debugging
+        with open(metadata_file(pcs_id, paper['PAPER ID']), "w") as fd:
+            fd.write(text)
+    return pcs_id, doi
+
+
+def skip_list_download(overwrite=True):
     if overwrite is False and os.path.exists(LIST_FILE):
         print("file already exists - skipping download")
-        return
+        return True
     if file_is_current(LIST_FILE):
         print("file downloaded within last 5 minutes - skipping download")
-        return
+        return True
+    return False
+
 
-    print("Logging in...")
-    session = requests.Session()
-    r = session.get(SESSION_PAGE)
-    # select_dashboard: 1 = Proceedings, 2 = PACM
-    r = session.post(LOGIN_PAGE, data={'user_loginname': USER_LOGINNAME, 'password': PASSWORD, 'select_dashboard': '1', 'button2': 'Login'})
-    print("Retrieving list of papers (might take up to one minute - TAPS is slow) ...")
-    r = session.get(PROC_PAGE)
-    root = etree.HTML(r.text)
-    rows = root.xpath("//table[@id = 'ce_data']/tbody/tr")
-    headers = root.xpath("//table[@id = 'ce_data']/thead/tr/th/div")
-    print(f"Found {len(rows)} papers.")  # number of papers
-    cols = [col.text.strip() for col in headers]
-
-    data = []
-    for row in rows:
-        assert(len(row) == len(cols))
-        d = {}
-        for i in range(len(row)):
-            # special cases:
-            if cols[i] == 'STATUS':
-                d["STATUS"] = get_status(row.getchildren()[i])
-            elif cols[i] == 'ACTIONS':
-                d["PDF_URL"] = get_pdf(row.getchildren()[i])
-                d["HTML_URL"] = get_html(row.getchildren()[i])
-                d["ERROR_URL"] = get_error(row.getchildren()[i])
-            elif row.getchildren()[i].text:
-                d[cols[i]] = row.getchildren()[i].text.strip()    
-                # FIXME: for some reason, Aptara put some paper titles which start with '"' within a further "<blnk>" element. For these, an empty title is returned. 
-                # Not a huge problem, however, as we do not use the title from TAPS anywhere
+def get_submissions(conf_id, user, password, overwrite=True, keep_metadata=False, workers=METADATA_WORKERS):
+    if skip_list_download(overwrite):
+        return
+    return list(iter_submissions(conf_id, user, password, keep_metadata, workers))
+
+
+def iter_submissions(conf_id, user, password, keep_metadata=False, workers=METADATA_WORKERS):
+    """Downloads the list of papers into LIST_FILE and yields the fields needed for downloading each paper
+    as soon as its row has been written - downloads can start while the list is still being retrieved."""
+    while True:
+        login(user, password)
+        print("Retrieving list of papers (might take up to one minute - TAPS is slow) ...")
+        r = session.get(PROC_PAGE.format(conf_id=conf_id), stream=True)
+        # the page is parsed while it is still being downloaded, its first table row holds the column names
+        rows = iter_paper_table(r.iter_content(PAGE_CHUNK_SIZE))
+        header = None if r.url.startswith(LOGIN_PAGE) else next(rows, None)
+        if header is not None:
+            break
+        r.close()
+        if not login_reused:
+            sys.exit(f"TAPS did not return a list of papers - please check the conference ID ({conf_id}) and your access rights")
+        print("Saved TAPS login is not valid any more - logging in again")
+        forget_login()
+    cols = [col.text.strip() for col in HEADER_XPATH(header)]
+    handlers = [(col, COLUMN_HANDLERS.get(col, set_text)) for col in cols]
+
+    fieldnames = [col for col in cols if col != "ACTIONS"] + ["PDF_URL", "HTML_URL", "ERROR_URL", "PCS_ID", "DOI"]
+    if keep_metadata:
+        os.makedirs(METADATA_DIR, exist_ok=True)
+
+    # the metadata of a paper does not change, so we only fetch it for papers we did not see in the last run
+    known_papers = {}
+    if os.path.exists(LIST_FILE):
+        with open(LIST_FILE, "r") as fd:
+            known_papers = {paper['PAPER ID']: paper for paper in DictReader(fd) if paper.get('PCS_ID')}
+
+    count = 0
+    # Metadata pages are fetched in parallel. Rows are written in table order as soon as they (and all rows
+    # before them) are complete, so an interrupted run still leaves a usable file.
+    pending = deque()  # (row, future or None) in table order
+    def write_row(d, future):
+        if future is not None:
+            d["PCS_ID"], d["DOI"] = future.result()
+        csv_writer.writerow(row_values(d))
+        fd.flush()
+        progress_bar.update()
+        # everything else is kept in the CSV only
+        return {field: d[field] for field in DOWNLOAD_FIELDS}
+
+    with open(LIST_FILE, "w") as fd, ThreadPoolExecutor(max_workers=workers) as executor, \
+            tqdm(unit=" papers", leave=False) as progress_bar:  # the number of papers is only known at the end
+        csv_writer = writer(fd)
+        csv_writer.writerow(fieldnames)
+        row_values = itemgetter(*fieldnames)  # the values of a row in column order
+        for row in rows:
+            assert(len(row) == len(cols))
+            d = {}
+            for (col, handler), cell in zip(handlers, row):
+                handler(d, col, cell)
+            known = known_papers.pop(d['PAPER ID'], None)  # not needed any more once written
+            if known and (not keep_metadata or os.path.exists(metadata_file(known["PCS_ID"], d['PAPER ID']))):
+                d["PCS_ID"], d["DOI"] = known["PCS_ID"], known["DOI"]
+                pending.append((d, None))
             else:
-                d[cols[i]] = ""
-        print(f"getting metadata for paper {d['PAPER ID']} ({d['TITLE']})")
-        d["METADATA"] = session.get(METADATA_PAGE+d['PAPER ID']).text
-        metadata = d['METADATA'].splitlines()
-        d["PCS_ID"] = metadata[9]
-        d["DOI"] = metadata[12]
-        data.append(d)
-
-    #print(cols)
-    cols += ["PDF_URL", "HTML_URL", "ERROR_URL", "METADATA", "PCS_ID", "DOI"]
-    cols.remove("ACTIONS")
-
-    with open(LIST_FILE, "w") as fd:
-        dw = DictWriter(fd, cols)
-        dw.writeheader()
-        for row in data:
-            dw.writerow(row)
-    return data
-
-
-def download_file(paper_id, url, filename, overwrite="modified"):
+                pending.append((d, executor.submit(get_metadata, conf_id, d, keep_metadata)))
+            while pending and (pending[0][1] is None or pending[0][1].done()):
+                yield write_row(*pending.popleft())
+                count += 1
+        while pending:
+            yield write_row(*pending.popleft())
+            count += 1
+    print(f"Found {count} papers.")  # number of papers
+
+
+def queue_submissions(papers, conf_id, user, password, keep_metadata=False, workers=METADATA_WORKERS):
     try:
-        doc = None
+        for paper in iter_submissions(conf_id, user, password, keep_metadata, workers):
+            papers.put(paper)
+    finally:
+        papers.put(None)  # end of list (also on errors)
+
+
+# The download cache maps each downloaded filename to the validators the server sent for it
+# ({"etag": ..., "last_modified": ..., "size": ..., "mtime": ..., "checked": ...}) so that unchanged files can be
+# skipped on the next run. Files checked against the server less than DOWNLOAD_CACHE_MAX_AGE seconds ago (and not
+# touched locally since) are skipped without any request.
+download_cache_lock = threading.Lock()  # the cache is saved from several threads
+
+def load_download_cache():
+    try:
+        with open(DOWNLOAD_CACHE_FILE) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_download_cache(cache):
+    with download_cache_lock:
+        with open(DOWNLOAD_CACHE_FILE + ".part", "w") as fd:
+            json.dump(dict(cache), fd, indent=1)  # copied at once, other threads may still add files
+        os.replace(DOWNLOAD_CACHE_FILE + ".part", DOWNLOAD_CACHE_FILE)
+
+
+def remember_file(cache, filename, headers, size, previous={}):
+    # a 304 response need not repeat the validators
+    cache[filename] = {'etag': headers.get("ETag", previous.get('etag')),
+                       'last_modified': headers.get("Last-Modified", previous.get('last_modified')),
+                       'size': size, 'mtime': os.path.getmtime(filename), 'checked': time.time()}
+
+
+def download_file(paper_id, url, filename, overwrite="modified", cache=None):
+    if cache is None:
+        cache = {}
+    try:
+        request_headers = {}
+        try:  # a single stat() tells us whether the file exists, how large it is, and when it was modified
+            stat = os.stat(filename)
+            file_size = stat.st_size
+        except FileNotFoundError:
+            file_size = None
+        known = cache.get(filename, {})
         # avoid unnecessary downloads
+        if overwrite == "modified" and file_size is not None and file_size == known.get('size') \
+                and stat.st_mtime == known.get('mtime') and time.time() - known.get('checked', 0) < DOWNLOAD_CACHE_MAX_AGE:
+            tqdm.write(f"   >{paper_id}: already downloaded and checked recently")
+            return True
         if overwrite == "none":
-            if os.path.exists(filename):  # only download if file changed
-                tqdm.write("   >... already downloaded")
+            if file_size is not None:  # only download if file changed
+                tqdm.write(f"   >{paper_id}: already downloaded")
                 return True
-        elif overwrite == "modified":
-            doc = urlopen(url, timeout=10)
-            doc_size = int(doc.getheader("Content-Length"))
-            if os.path.exists(filename):  # only download if file changed
-                file_size = os.stat(filename).st_size
-                if file_size == doc_size:
-                    tqdm.write("   >... already downloaded and not changed on server")
-                    return True
-        # ok, we want to download the file. make request if not already done
-        if not doc:
-            doc = urlopen(url, timeout=10)
-            doc_size = int(doc.getheader("Content-Length"))
-        with open(filename, 'wb') as fd:
-            #print(f" ({doc_size/1000000.0:.2f} MB)")
-            progress_bar = tqdm(total=doc_size, unit='iB', unit_scale=True, leave=False)
-            while True:
-                data = doc.read(1024*100)
-                if not data:
-                    break
-                fd.write(data)
-                progress_bar.update(len(data))
-            progress_bar.close()
+        elif overwrite == "modified" and file_size is not None and file_size == known.get('size'):
+            # the server answers 304 without a body if the file has not changed since we downloaded it
+            if known.get('etag'):
+                request_headers['If-None-Match'] = known['etag']
+            if known.get('last_modified'):
+                request_headers['If-Modified-Since'] = known['last_modified']
+        elif overwrite == "modified" and file_size is not None:
+            # files downloaded before the cache existed can only be compared by size.
+            # HEAD only transfers the headers, which is all we need for that
+            head = session.head(url, allow_redirects=True, timeout=10)
+            if head.status_code in NOT_FOUND:
+                tqdm.write(f"   >{paper_id}: file not found on server")
+                return False
+            if head.ok and int(head.headers.get("Content-Length", -1)) == file_size:
+                remember_file(cache, filename, head.headers, file_size)
+                tqdm.write(f"   >{paper_id}: already downloaded and not changed on server")
+                return True
+        doc = session.get(url, headers=request_headers, stream=True, timeout=10)
+        if doc.status_code == 304:  # not modified
+            doc.close()
+            remember_file(cache, filename, doc.headers, file_size, known)
+            tqdm.write(f"   >{paper_id}: already downloaded and not changed on server")
+            return True
+        if doc.status_code in NOT_FOUND:
+            doc.close()
+            tqdm.write(f"   >{paper_id}: file not found on server")
+            return False
+        doc.raise_for_status()  # any other error is unexpected
+        doc_size = int(doc.headers.get("Content-Length", -1))  # -1: unknown
+        # same check for servers which refuse HEAD requests
+        if overwrite == "modified" and not request_headers and file_size == doc_size:
+            doc.close()
+            remember_file(cache, filename, doc.headers, doc_size)
+            tqdm.write(f"   >{paper_id}: already downloaded and not changed on server")
             return True
-    except (ValueError, HTTPError) as e:
-        tqdm.write("   >... file not found on server")
+        with doc, open(filename, 'wb') as fd:
+            tqdm.write(f"   >{paper_id}: downloading {filename}" + (f" ({doc_size/1000000.0:.2f} MB)" if doc_size >= 0 else ""))
+            doc.raw.decode_content = True  # undo gzip/deflate transfer encoding
+            shutil.copyfileobj(doc.raw, fd, DOWNLOAD_CHUNK_SIZE)  # the copy loop runs in C
+            file_size = fd.tell()
+        # only remembered once the file is complete, an interrupted download is fetched again
+        remember_file(cache, filename, doc.headers, file_size)
+        return True
+    except requests.exceptions.RetryError as e:
+        tqdm.write(f"   >{paper_id}: SERVER ERROR - giving up after {DOWNLOAD_RETRIES.total} retries")
+        print(str(e))
+        return False
+    except (ValueError, requests.RequestException, urllib3.exceptions.HTTPError) as e:
+        tqdm.write(f"   >{paper_id}: download failed")
         print(str(e))
         return False
 
 
 
-def download_files(data, filetypes, overwrite=False):
+def download_files(data, filetypes, user, password, overwrite=False, workers=DOWNLOAD_WORKERS):
     for filetype in filetypes:
-        try:
-            os.makedirs(filetype['dir'])
-        except FileExistsError:
-            print(f"directory '{filetype['dir']}' already exists, writing into it")
-    for paper in tqdm(data):
-        pcs_id = paper['PCS_ID']
-        taps_id = paper['PAPER ID']
-        print(f"Paper: {pcs_id} (TAPS ID: {taps_id})")
-        for filetype in filetypes:
-            if len(paper[filetype['field']]) > 1:
-                url = paper[filetype['field']]
-                filename = f"{filetype['dir']}/{pcs_id}_{taps_id}.{filetype['ext']}"
-                print(f"Retrieving {filetype['ext']} file: {paper[filetype['field']]}")
-                download_file(taps_id, url, filename)
-            else:
-                print("   >... not submitted")
-
-
-# ## Download HTML and PDF
-
-data = get_submissions()
-if data is None:
-    data = []
-    with open(LIST_FILE, "r") as fd:
-        dr = DictReader(fd)
-        for row in dr:
-            data.append(row)
+        os.makedirs(filetype['dir'], exist_ok=True)
+    login(user, password)  # not done yet if the paper list has not been downloaded again
+    cache = load_download_cache()
+    # every file is downloaded on its own, so that papers with several files do not hold up the others.
+    # The semaphore keeps us at most a few files ahead of the downloads if data is read lazily from the CSV.
+    pending = threading.BoundedSemaphore(2 * workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(unit=" files") as progress_bar:
+            def done(future):
+                progress_bar.update()
+                pending.release()
+                if progress_bar.n % DOWNLOAD_CACHE_SAVE_INTERVAL == 0:  # an interrupted run keeps most of its cache
+                    save_download_cache(cache)
+            futures = []
+            for paper in data:
+                pcs_id = paper['PCS_ID']
+                taps_id = paper['PAPER ID']
+                for filetype in filetypes:
+                    if len(paper[filetype['field']]) > 1:
+                        url = paper[filetype['field']]
+                        filename = f"{filetype['dir']}/{pcs_id}_{taps_id}.{filetype['ext']}"
+                        pending.acquire()
+                        future = executor.submit(download_file, taps_id, url, filename, cache=cache)
+                        future.add_done_callback(done)
+                        futures.append(future)
+                    else:
+                        print(f"   >{taps_id}: {filetype['ext']} not submitted")
+        for future in futures:
+            future.result()
+    finally:
+        save_download_cache(cache)
 
 
 FILES = [{'field': 'PDF_URL', 'dir': 'TAPS_PDF', 'ext': 'pdf'},
          {'field': 'HTML_URL', 'dir': 'TAPS_HTML', 'ext': 'html'}]
 
-# poor man's argparse
-filetypes = []
-if "--all" in sys.argv:
-    filetypes = FILES
-else:
-    if "--pdf" in sys.argv:
-        filetypes.append(FILES[0])
-    if "--html" in sys.argv:
-        filetypes.append(FILES[1])
-if len(filetypes) == 0:
-    sys.exit()
-
 
-download_files(data, filetypes)
+def netrc_credentials():
+    try:
+        credentials = netrc.netrc().authenticators(TAPS_HOST)
+    except (OSError, netrc.NetrcParseError):
+        credentials = None
+    if credentials is None:
+        return None, None
+    user, _, password = credentials
+    return user, password
+
+
+@click.command(help=INFO)
+@click.option('--conf-id', envvar='CONF_ID', required=True, help='proceedings ID in TAPS (can also be set via environment variable CONF_ID)')
+@click.option('--user', help='TAPS user (can also be set via environment variable TAPS_USER or ~/.netrc)')
+@click.option('--password', help='TAPS password (can also be set via environment variable TAPS_PASSWORD or ~/.netrc)')
+@click.option('--pdf', is_flag=True, default=False, help='download all PDF files into ./TAPS_PDF/')
+@click.option('--html', is_flag=True, default=False, help='download all HTML files into ./TAPS_HTML/')
+@click.option('--all', 'all_files', is_flag=True, default=False, help='download PDF and HTML files')
+@click.option('--keep-metadata', is_flag=True, default=False, help=f'store the raw metadata page of each paper in ./{METADATA_DIR}/')
+@click.option('--jobs', default=DOWNLOAD_WORKERS, type=click.IntRange(min=1), help='number of files downloaded in parallel', show_default=True)
+@click.option('--metadata-jobs', envvar='TAPS_METADATA_JOBS', default=METADATA_WORKERS, type=click.IntRange(min=1),
+              help='number of metadata pages fetched in parallel', show_default=True)
+def main(conf_id, user, password, pdf, html, all_files, keep_metadata, jobs, metadata_jobs):
+    print(INFO)
+    netrc_user, netrc_password = netrc_credentials()
+    # only ask if we are run interactively - otherwise we would block forever
+    user = user or netrc_user or (click.prompt("TAPS user") if sys.stdin.isatty() else None)
+    password = password or netrc_password or (click.prompt("TAPS password", hide_input=True) if sys.stdin.isatty() else None)
+    if not user or not password:
+        raise click.UsageError("TAPS credentials missing - use --user/--password, TAPS_USER/TAPS_PASSWORD, or ~/.netrc")
+
+    filetypes = []
+    if all_files:
+        filetypes = FILES
+    else:
+        if pdf:
+            filetypes.append(FILES[0])
+        if html:
+            filetypes.append(FILES[1])
+    # one pooled connection per worker
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=metadata_jobs + (jobs if filetypes else 0) + 1,
+                                          max_retries=DOWNLOAD_RETRIES))
+    if len(filetypes) == 0:
+        get_submissions(conf_id, user, password, keep_metadata=keep_metadata, workers=metadata_jobs)
+        return
 
+    if skip_list_download():
+        # rows are read lazily while downloading
+        with open(LIST_FILE, "r") as fd:
+            download_files(DictReader(fd), filetypes, user, password, workers=jobs)
+    else:
+        # each paper is downloaded as soon as its metadata is known. The list is retrieved in its own thread
+        # so that it is never held up by the downloads (the queue is unbounded, papers are small).
+        papers = queue.Queue()
+        with ThreadPoolExecutor(max_workers=1) as producer:
+            listing = producer.submit(queue_submissions, papers, conf_id, user, password, keep_metadata, metadata_jobs)
+            download_files(iter(papers.get, None), filetypes, user, password, workers=jobs)
+            listing.result()  # re-raises errors of the list download
+
+
+if __name__ == "__main__":
+    main(auto_envvar_prefix='TAPS')